@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# daily and monthly traffic volume from rawlog files of ng-upnp2mrtg3.py
+#
+# account.py update /var/lib/mrtg/*.rawlog     after each poll
+# account.py report /var/lib/mrtg/fritzbox.rawlog --month 2026-10
+#
+# The totals are kept in a checkpoint file next to each rawlog file
+# (<rawlog>.account) together with the position up to which the rawlog
+# has been read, so an update only reads the lines appended since.
+
+import importlib
+import argparse
+import datetime
+import json
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+upnp = importlib.import_module('ng-upnp2mrtg3')
+
+# number of days kept in the checkpoint
+KEEP_DAYS = 400
+
+def counter_delta(new, last, offset):
+    """ traffic between two samples
+
+    :param new: current counter (corrected by --nowrap, if used)
+    :param last: previous counter
+    :param offset: current offset of nowrap (or None)
+    :return: bytes
+    .note: if the counter went back the nowrap state has been lost (or
+           nowrap is not used), the counter started again at 0
+    """
+    if (new is None) or (last is None):
+        return 0
+    if new >= last:
+        return new - last
+    return new - (offset or 0)
+
+class Checkpoint:
+    """ totals per day and month and the read position of a rawlog file
+    """
+
+    def __init__(self, rawlog):
+        self.rawlog = rawlog
+        self.filename = rawlog + '.account'
+        self.inode = None
+        self.pos = 0
+        self.last = [None, None]        # last counters in, out
+        self.days = {}                  # "YYYY-mm-dd" -> [in, out]
+        self.months = {}                # "YYYY-mm" -> [in, out]
+
+        try:
+            data = json.load(open(self.filename, 'r'))
+            self.inode = data['inode']
+            self.pos = data['pos']
+            self.last = data['last']
+            self.days = data['days']
+            self.months = data['months']
+        except (IOError, ValueError, KeyError):
+            pass
+
+    def store(self):
+        for day in sorted(self.days)[:-KEEP_DAYS]:
+            del self.days[day]
+
+        tmp = "%s.%s" % (self.filename, os.getpid())
+        f = open(tmp, 'w')
+        json.dump({'inode': self.inode, 'pos': self.pos, 'last': self.last,
+                   'days': self.days, 'months': self.months}, f, sort_keys=True)
+        f.close()
+        os.replace(tmp, self.filename)
+
+    def update(self):
+        """ add the lines appended to the rawlog since the last update
+
+        :return: number of samples read
+        """
+        st = os.stat(self.rawlog)
+        if (st.st_ino != self.inode) or (st.st_size < self.pos):
+            # new or rotated file
+            self.inode = st.st_ino
+            self.pos = 0
+
+        f = open(self.rawlog, 'rb')
+        f.seek(self.pos)
+        data = f.read()
+        f.close()
+
+        # a line still being written is read next time
+        end = data.rfind(b'\n') + 1
+        self.pos += end
+
+        count = 0
+        for line in data[:end].decode('utf-8').splitlines():
+            sample = upnp.parse_rawlog_line(line)
+            if sample is None:
+                continue
+            count += 1
+            stamp, inbytes, outbytes, uptime, inoffset, outoffset = sample
+            din = counter_delta(inbytes, self.last[0], inoffset)
+            dout = counter_delta(outbytes, self.last[1], outoffset)
+            if inbytes is not None:
+                self.last[0] = inbytes
+            if outbytes is not None:
+                self.last[1] = outbytes
+
+            day = datetime.date.fromtimestamp(stamp)
+            for totals, key in ((self.days, day.strftime('%Y-%m-%d')), (self.months, day.strftime('%Y-%m'))):
+                t = totals.setdefault(key, [0, 0])
+                t[0] += din
+                t[1] += dout
+        return count
+
+def human(n):
+    """ bytes in human readable form
+    """
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if n < 1024:
+            return '%.1f %s' % (n, unit)
+        n /= 1024
+    return '%.1f TiB' % n
+
+def update(args):
+    for rawlog in args.rawlog:
+        try:
+            cp = Checkpoint(rawlog)
+            count = cp.update()
+            cp.store()
+        except IOError as msg:
+            print('*** %s: %s' % (rawlog, msg))
+            continue
+        if args.verbose:
+            print('%s: %s new samples' % (rawlog, count))
+
+def report(args):
+    for rawlog in args.rawlog:
+        cp = Checkpoint(rawlog)
+        print(rawlog)
+        print('=' * len(rawlog))
+        for key in sorted(cp.days):
+            if (args.month is None) or key.startswith(args.month):
+                print('%s  in %12s  out %12s' % (key, human(cp.days[key][0]), human(cp.days[key][1])))
+        for key in sorted(cp.months):
+            if (args.month is None) or key == args.month:
+                print('%-10s  in %12s  out %12s' % (key, human(cp.months[key][0]), human(cp.months[key][1])))
+        print()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='traffic volume from rawlog files')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('update', help='add new lines of the rawlog files to their checkpoints')
+    p.add_argument('rawlog', nargs='+')
+    p.add_argument('--verbose',
+                   action='store_true',
+                   help='show the number of new samples')
+    p.set_defaults(func=update)
+
+    p = sub.add_parser('report', help='show daily and monthly totals')
+    p.add_argument('rawlog', nargs='+')
+    p.add_argument('--month',
+                   help='only this month, "YYYY-mm"')
+    p.set_defaults(func=report)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# convert rawlog files of ng-upnp2mrtg3.py into sample archives and query them
+#
+# archive.py convert fritzbox.rawlog fritzbox.arc
+# archive.py query fritzbox.arc --from "2026-10-01" --to "2026-10-02 12:00"
+# archive.py info fritzbox.arc
+
+import importlib
+import argparse
+import datetime
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+upnp = importlib.import_module('ng-upnp2mrtg3')
+
+def parse_time(s):
+    """ convert "YYYY-mm-dd[ HH:MM[:SS]]" into unix time
+    """
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return int(time.mktime(datetime.datetime.strptime(s, fmt).timetuple()))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('invalid time: %s' % s)
+
+def convert(args):
+    archive = upnp.Sample_archive(args.archive)
+    last = None
+    if archive.index:
+        last = archive.index[-1][1]
+
+    samples = []
+    skipped = 0
+    for line in open(args.rawlog, 'r'):
+        sample = upnp.parse_rawlog_line(line)
+        if (sample is None) or ((last is not None) and sample[0] <= last):
+            skipped += 1
+            continue
+        samples.append(sample)
+        last = sample[0]
+        if len(samples) >= args.block:
+            archive.append(samples, args.block)
+            samples = []
+    archive.append(samples, args.block)
+
+    print('%s samples in %s, %s lines skipped' % (len(archive), args.archive, skipped))
+    print('rawlog %s bytes, archive %s bytes' % (os.path.getsize(args.rawlog), os.path.getsize(args.archive)))
+
+def query(args):
+    archive = upnp.Sample_archive(args.archive)
+    out = sys.stdout
+    for sample in archive.read(args.start, args.end):
+        out.write(upnp.format_rawlog_line(sample))
+
+def info(args):
+    archive = upnp.Sample_archive(args.archive)
+    print('%s: %s samples in %s blocks' % (args.archive, len(archive), len(archive.index)))
+    for t_first, t_last, offset, length, count in archive.index:
+        print('  %s - %s  %6s samples  %8s bytes' % (
+            datetime.datetime.fromtimestamp(t_first), datetime.datetime.fromtimestamp(t_last), count, length))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='sample archives of ng-upnp2mrtg3.py')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+
+    p = sub.add_parser('convert', help='append the samples of a rawlog file to an archive')
+    p.add_argument('rawlog')
+    p.add_argument('archive')
+    p.add_argument('--block',
+                   type=int,
+                   default=upnp.ARCHIVE_BLOCK,
+                   help='samples per block (default: %s)' % upnp.ARCHIVE_BLOCK)
+    p.set_defaults(func=convert)
+
+    p = sub.add_parser('query', help='output samples of a time range in rawlog format')
+    p.add_argument('archive')
+    p.add_argument('--from',
+                   dest='start',
+                   type=parse_time,
+                   help='first time, "YYYY-mm-dd[ HH:MM[:SS]]"')
+    p.add_argument('--to',
+                   dest='end',
+                   type=parse_time,
+                   help='last time')
+    p.set_defaults(func=query)
+
+    p = sub.add_parser('info', help='show the blocks of an archive')
+    p.add_argument('archive')
+    p.set_defaults(func=info)
+
+    args = parser.parse_args()
+    args.func(args)
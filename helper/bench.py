@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# micro benchmarks for the parsing and state handling of ng-upnp2mrtg3.py
+#
+# bench.py              run and compare with the stored baseline
+# bench.py --save       run and store the result as new baseline
+# bench.py --memory     memory per target of --targets/--stream
+
+import importlib
+import contextlib
+import argparse
+import tempfile
+import tracemalloc
+import timeit
+import time
+import io
+import json
+import sys
+import os
+
+HELPERDIR = os.path.dirname(os.path.abspath(__file__))
+DATADIR = os.path.join(HELPERDIR, 'bench_data')
+BASELINE = os.path.join(HELPERDIR, 'bench_baseline.json')
+
+sys.path.insert(0, os.path.dirname(HELPERDIR))
+upnp = importlib.import_module('ng-upnp2mrtg3')
+import scan
+
+def read_data(name):
+    """ get a captured payload
+
+    :param name: file name in bench_data
+    :return: content as string
+    """
+    return open(os.path.join(DATADIR, name), 'rb').read().decode('utf-8')
+
+def create_capture(filename):
+    """ create a capture file for --replay from the payloads of the Fritzbox
+
+    :param filename: capture file to write
+    .note: the answer to GetTotalBytesSent is derived from the one to GetTotalBytesReceived
+    """
+    router = upnp.Profile_db().find('fritzbox_7490')
+    received = read_data('fritzbox_7490_GetTotalBytesReceived.http')
+    answers = [received, received.replace('Received', 'Sent'), read_data('fritzbox_7490_GetStatusInfo.http')]
+    uc = upnp.Upnpclient(router.host, router.port)
+    f = open(filename, 'w')
+    for action, answer in zip((router.incoming, router.outgoing, router.uptime), answers):
+        request = uc.create_message(action.path, action.schema, action.action, action.args)
+        f.write(json.dumps({'host': router.host, 'port': router.port, 'time': 0,
+                            'request': request, 'response': [[0, answer]]}) + '\n')
+    f.close()
+
+def run_main(argv):
+    """ run ng-upnp2mrtg3.py with the given options, without output
+    """
+    sys.argv = ['ng-upnp2mrtg3.py'] + argv
+    with contextlib.redirect_stdout(io.StringIO()):
+        upnp.main()
+
+def create_benchmarks(tmpdir):
+    """ create the benchmarks
+
+    :param tmpdir: directory for state files
+    :return: list of (name, function without parameters)
+    """
+    fb_bytes = read_data('fritzbox_7490_GetTotalBytesReceived.http')
+    fb_status = read_data('fritzbox_7490_GetStatusInfo.http')
+    nc_bytes = read_data('nc_premium_GetTotalBytesSent.http')
+    archer_status = read_data('archer_c7_GetStatusInfo.http')
+    notify = read_data('fritzbox_7490_ssdp_notify.txt')
+
+    uc = upnp.Upnpclient('192.168.178.1', 49000)
+
+    nowrap_file = os.path.join(tmpdir, 'bench.nowrap')
+    nowrap = upnp.Nowrap_handler(nowrap_file)
+    nowrap.get_corr_values('3197554621', '18446744071562067968', 1205876, 1792000000)
+    nowrap.store_info()
+    counter = [0]
+
+    def nowrap_correct():
+        counter[0] += 300
+        nowrap.get_corr_values(3197554621 + counter[0], 1000 + counter[0],
+                               1205876 + counter[0], 1792000000 + counter[0])
+
+    capture = os.path.join(tmpdir, 'fritzbox_7490.capture')
+    create_capture(capture)
+    main_argv = ['-t', 'fritzbox_7490', '--replay', capture, '--replay-speed', '0',
+                 '--nowrap', os.path.join(tmpdir, 'main.nowrap')]
+
+    registry = scan.Ssdp_registry()
+    notify_headers = scan.split2dict(notify)
+
+    def parse(payload, tag, types):
+        # fed in pieces of 1K as by Upnpclient.send
+        parser = upnp.Soap_parser(tag, types)
+        data = payload.encode('utf-8')
+        for i in range(0, len(data), 1024):
+            if parser.feed(data[i:i + 1024]):
+                break
+        return parser.result()
+
+    return [
+        ('Soap_parser fritzbox', lambda: parse(fb_bytes, 'NewTotalBytesReceived', 'ui4')),
+        ('Soap_parser archer status', lambda: parse(archer_status, ('NewConnectionStatus', 'NewUptime'), None)),
+        ('gettag fritzbox', lambda: upnp.gettag(fb_bytes, 'NewTotalBytesReceived')),
+        ('gettag nc_premium', lambda: upnp.gettag(nc_bytes, 'NewTotalBytesSent')),
+        ('gettag archer uptime', lambda: upnp.gettag(archer_status, 'NewUptime')),
+        ('get_response_code', lambda: upnp.get_response_code(fb_status)),
+        ('create_message', lambda: uc.create_message('/igdupnp/control/WANCommonIFC1',
+            'WANCommonInterfaceConfig:1', 'GetTotalBytesReceived')),
+        ('Nowrap_handler load', lambda: upnp.Nowrap_handler(nowrap_file)),
+        ('Nowrap_handler correct', nowrap_correct),
+        ('Nowrap_handler store', nowrap.store_info),
+        ('dhms', lambda: upnp.dhms('1205876')),
+        ('archer_uptime_conv', lambda: upnp.archer_uptime_conv('103 Days, 12:49:51')),
+        ('split2dict ssdp', lambda: scan.split2dict(notify)),
+        ('Ssdp_registry update', lambda: registry.update(notify_headers)),
+        ('main fritzbox replay', lambda: run_main(main_argv)),
+    ]
+
+def synthetic_targets(count):
+    """ targets as read from a large --targets file
+
+    :param count: number of targets
+    :return: generator of Target
+    """
+    profiles = ('fritzbox_7490', 'archer_c7', 'nc_premium')
+    for i in range(count):
+        host = '10.%s.%s.%s' % (i >> 16 & 255, i >> 8 & 255, i & 255)
+        yield upnp.Target(profiles[i % len(profiles)], host, 49000, '/var/lib/mrtg/%s.nowrap' % host,
+                          None, None, None, 300, None, None, None, None, None)
+
+def allocated(build):
+    """ memory kept by the result of a function and the most it used meanwhile
+
+    :param build: function without parameters
+    :return: (bytes kept, peak bytes)
+    """
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return after - before, peak - before
+
+def memory_report(counts=(10000, 100000)):
+    """ print the memory per target of the target list and of the scheduler
+    """
+    scheduler = upnp.Poll_scheduler(1)
+
+    def sorted_table(count):
+        table = upnp.Target_table(synthetic_targets(count))
+        table.sort()
+        return table
+
+    def table_and_heap(count):
+        table = upnp.Target_table(synthetic_targets(count))
+        heap = scheduler.initial_heap(table.host, table.interval, time.time())
+        return table, heap
+
+    builds = [
+        ('list of Target', lambda count: list(synthetic_targets(count))),
+        ('Target_table', lambda count: upnp.Target_table(synthetic_targets(count))),
+        ('Target_table sorted', sorted_table),
+        ('Target_table + schedule', table_and_heap),
+    ]
+    print("%-26s %8s %14s %14s" % ('memory', 'targets', 'bytes/target', 'peak/target'))
+    print("%-26s %8s %14s %14s" % ('-' * 26, '-' * 8, '-' * 14, '-' * 14))
+    for count in counts:
+        for name, build in builds:
+            kept, peak = allocated(lambda: build(count))
+            print("%-26s %8s %14.0f %14.0f" % (name, count, kept / count, peak / count))
+
+def measure(func, repeat=5, min_time=0.2):
+    """ measure the time of one call
+
+    :param func: function to measure
+    :param repeat: number of measurements, the fastest is used
+    :param min_time: minimum duration of a measurement in seconds
+    :return: time per call in nanoseconds
+    """
+    timer = timeit.Timer(func)
+    number, duration = timer.autorange()
+    number = max(number, int(number * min_time / max(duration, 1e-9)))
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+def report(results, baseline):
+    """ print results compared with the baseline
+
+    :param results: dict name -> ns per call
+    :param baseline: dict name -> ns per call (may be empty)
+    """
+    print("%-26s %12s %12s %8s" % ('benchmark', 'baseline ns', 'current ns', 'change'))
+    print("%-26s %12s %12s %8s" % ('-' * 26, '-' * 12, '-' * 12, '-' * 8))
+    for name, ns in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print("%-26s %12s %12.0f %8s" % (name, '-', ns, ''))
+        else:
+            print("%-26s %12.0f %12.0f %+7.1f%%" % (name, base, ns, (ns - base) / base * 100))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='micro benchmarks for ng-upnp2mrtg3.py')
+    parser.add_argument('--baseline',
+                        default=BASELINE,
+                        help='file with the baseline (default: %s)' % BASELINE)
+    parser.add_argument('--save',
+                        action='store_true',
+                        help='store the results as new baseline')
+    parser.add_argument('--filter',
+                        help='run only benchmarks containing this string')
+    parser.add_argument('--memory',
+                        action='store_true',
+                        help='measure the memory per target instead')
+
+    args = parser.parse_args()
+
+    if args.memory:
+        memory_report()
+        sys.exit(0)
+
+    try:
+        baseline = json.load(open(args.baseline, 'r'))
+    except (IOError, ValueError):
+        baseline = {}
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, func in create_benchmarks(tmpdir):
+            if (args.filter is None) or (args.filter in name):
+                results[name] = round(measure(func), 1)
+
+    report(results, baseline)
+
+    if args.save:
+        baseline.update(results)
+        f = open(args.baseline, 'w')
+        json.dump(baseline, f, indent=1, sort_keys=True)
+        f.write('\n')
+        f.close()
+        print('** Baseline saved in', args.baseline)
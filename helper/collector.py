@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# receive samples shipped by ng-upnp2mrtg3.py (--spool, --ship) and store them
+#
+# collector.py /var/lib/upnp-samples --listen 7420
+#
+# Each series ("poller/host:port") is appended to a sample archive in the
+# store directory (see helper/archive.py to query them).  Samples not newer
+# than the last one in the archive are skipped, so batches shipped twice
+# (e.g. after a lost acknowledgement) do no harm.
+
+import importlib
+import argparse
+import socketserver
+import threading
+import re
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+upnp = importlib.import_module('ng-upnp2mrtg3')
+
+def archive_name(store, series):
+    """ file name of the archive of a series
+
+    :param store: directory of the archives
+    :param series: name of the series, e.g. "site12/192.168.178.1:49000"
+    :return: path, characters unsafe in file names replaced by "_"
+    """
+    return os.path.join(store, re.sub(r'[^A-Za-z0-9.:+-]', '_', series) + '.arc')
+
+class Store:
+    """ archives of the series, one writer at a time
+    """
+
+    def __init__(self, directory, verbose=False):
+        self.directory = directory
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def ingest(self, series, block):
+        """ append a shipped block to the archive of its series
+
+        :return: number of samples stored
+        """
+        samples = upnp.decode_block(block)
+        with self.lock:
+            archive = upnp.Sample_archive(archive_name(self.directory, series))
+            last = archive.index[-1][1] if archive.index else None
+            samples = [s for s in samples if (s[0] is not None) and ((last is None) or s[0] > last)]
+            archive.append(samples)
+        if self.verbose:
+            print('%s: %s samples' % (series, len(samples)))
+        return len(samples)
+
+def read_exactly(rfile, n):
+    data = rfile.read(n)
+    if len(data) != n:
+        raise EOFError()
+    return data
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        store = self.server.store
+        try:
+            if read_exactly(self.rfile, len(upnp.SHIP_MAGIC)) != upnp.SHIP_MAGIC:
+                return
+            while True:
+                blocklen, namelen = upnp.SHIP_FRAME.unpack(read_exactly(self.rfile, upnp.SHIP_FRAME.size))
+                if blocklen == 0:
+                    break
+                series = read_exactly(self.rfile, namelen).decode('utf-8')
+                block = read_exactly(self.rfile, blocklen)
+                try:
+                    store.ingest(series, block)
+                    self.wfile.write(upnp.SHIP_ACK)
+                except (ValueError, IOError, IndexError) as msg:
+                    print('*** %s from %s: %s' % (series, self.client_address[0], msg))
+                    self.wfile.write(upnp.SHIP_NAK)
+                self.wfile.flush()
+        except EOFError:
+            pass
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='collect samples shipped by ng-upnp2mrtg3.py')
+    parser.add_argument('store', help='directory of the sample archives')
+    parser.add_argument('--listen',
+                        default='7420',
+                        help='[address:]port to listen on (default: 7420)')
+    parser.add_argument('--verbose',
+                        action='store_true',
+                        help='show each batch received')
+    args = parser.parse_args()
+
+    address, sep, port = args.listen.rpartition(':')
+    server = Server((address.strip('[]'), int(port)), Handler)
+    server.store = Store(args.store, args.verbose)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# remove spikes from rawlog files and sample archives of ng-upnp2mrtg3.py
+#
+# despike.py fritzbox.rawlog fixed.rawlog --maxbytes1 12500000 --maxbytes2 5000000
+# despike.py fritzbox.arc fixed.arc --mode clamp
+#
+# The whole series is processed column by column: the increases between
+# the samples are computed at once, the ones beyond the link capacity are
+# rejected (no traffic) or clamped (full capacity) and the counters are
+# summed up again.  The offsets of --nowrap are lowered by the same amount.
+# Without --maxbytes1/2 the capacity is estimated from the series itself.
+#
+# A counter going back (reset without --nowrap) starts a new run, the values
+# after it are kept as they are.
+
+import importlib
+import argparse
+import array
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+upnp = importlib.import_module('ng-upnp2mrtg3')
+
+# percentile of the rates taken as typical peak for the estimated capacity
+PEAK_PERCENTILE = 0.99
+
+def estimate_capacity(times, counter):
+    """ guess the link capacity from a series
+
+    :param times: array of unix times
+    :param counter: list of counter values (None: unknown)
+    :return: bytes/s or None if the series is too short
+    """
+    rates = sorted([(c - lc) / (t - lt)
+                    for t, lt, c, lc in zip(times[1:], times, counter[1:], counter)
+                    if (c is not None) and (lc is not None) and t > lt and c >= lc])
+    if len(rates) < 10:
+        return None
+    return rates[int(len(rates) * PEAK_PERCENTILE)] * upnp.RATE_HEADROOM
+
+def despike_column(times, counter, offset, maxbytes, mode):
+    """ filter one counter of a series
+
+    :param times: array of unix times
+    :param counter: list of counter values (None: unknown), changed in place
+    :param offset: list of nowrap offsets (None: not logged), changed in place
+    :param maxbytes: capacity in bytes/s
+    :param mode: 'reject' or 'clamp'
+    :return: number of spikes
+    """
+    # increases between known values, None where the series restarts
+    known = [i for i, c in enumerate(counter) if c is not None]
+    deltas = [None] + [counter[i] - counter[j] if counter[i] >= counter[j] else None
+                       for j, i in zip(known, known[1:])]
+    allowed = [d if d is None else upnp.limit_delta(d, times[i] - times[j], maxbytes, mode)
+               for d, i, j in zip(deltas, known, [None] + known)]
+
+    # running sum of the removed bytes, reset where the counter restarts
+    spikes = 0
+    removed = 0
+    for i, d, a in zip(known, deltas, allowed):
+        if d is None:
+            removed = 0
+        elif a != d:
+            removed += d - a
+            spikes += 1
+        if removed:
+            counter[i] -= removed
+            if offset[i] is not None:
+                offset[i] -= removed
+    return spikes
+
+def read_series(filename):
+    """ read a rawlog file or an archive
+
+    :return: (list of samples, True if it is an archive)
+    """
+    f = open(filename, 'rb')
+    magic = f.read(len(upnp.ARCHIVE_MAGIC))
+    f.close()
+    if magic == upnp.ARCHIVE_MAGIC:
+        return list(upnp.Sample_archive(filename).read()), True
+    samples = []
+    for line in open(filename, 'r'):
+        sample = upnp.parse_rawlog_line(line)
+        if sample is not None:
+            samples.append(sample)
+    return samples, False
+
+def write_series(filename, samples, archive):
+    tmp = "%s.%s" % (filename, os.getpid())
+    if archive:
+        upnp.Sample_archive(tmp).append(samples)
+    else:
+        f = open(tmp, 'w')
+        f.write(''.join([upnp.format_rawlog_line(s) for s in samples]))
+        f.close()
+    os.replace(tmp, filename)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='remove spikes from rawlog files and sample archives')
+    parser.add_argument('input', help='rawlog file or archive')
+    parser.add_argument('output', help='repaired copy (same format as input)')
+    parser.add_argument('--mode',
+                        choices=['reject', 'clamp'],
+                        default='reject',
+                        help='replace spikes by no traffic or by the capacity (default: reject)')
+    parser.add_argument('--maxbytes1',
+                        type=int,
+                        help='capacity of the link in bytes/s (incoming), default: estimated')
+    parser.add_argument('--maxbytes2',
+                        type=int,
+                        help='capacity of the link in bytes/s (outgoing), default: estimated')
+    args = parser.parse_args()
+
+    samples, archive = read_series(args.input)
+    samples.sort(key=lambda s: s[0])
+    columns = [list(c) for c in zip(*samples)] or [[] for i in range(upnp.ARCHIVE_COLUMNS)]
+    times = array.array('q', columns[0])
+
+    for name, col, offcol, maxbytes in (('in', 1, 4, args.maxbytes1), ('out', 2, 5, args.maxbytes2)):
+        if maxbytes is None:
+            maxbytes = estimate_capacity(times, columns[col])
+            if maxbytes is None:
+                print('%s: too few samples to estimate the capacity, use --maxbytes%s' % (name, col))
+                continue
+            print('%s: estimated capacity %.0f bytes/s' % (name, maxbytes))
+        spikes = despike_column(times, columns[col], columns[offcol], maxbytes, args.mode)
+        print('%s: %s spikes %s' % (name, spikes, 'clamped' if args.mode == 'clamp' else 'rejected'))
+
+    write_series(args.output, list(zip(*columns)), archive)
+    print('%s samples written to %s' % (len(samples), args.output))
@@ -3,15 +3,22 @@
 
 import re
 from threading import Thread, Lock
+import collections
+import heapq
 import socket
 import struct
 import argparse
+import time
+import sys
 
 MCAST_GRP = "239.255.255.250"
 MCAST_PORT = 1900
 
-result_list = []
-result_list_lock = Lock()
+# lifetime of an announcement without "CACHE-CONTROL: max-age" (seconds)
+DEFAULT_MAX_AGE = 1800
+
+# maximum number of devices kept by the registry
+REGISTRY_SIZE = 4096
 
 request_end = False
 
@@ -23,22 +30,138 @@ def split2dict(lines):
     """
     res = {}
     for s in lines.splitlines():
-        ma = re.match('^(.+?):\s*(.+)$', s)
+        ma = re.match(r'^(.+?):\s*(.+)$', s)
         if ma is not None:
             res[ ma.group(1).lower() ] = ma.group(2)
     return res
 
+def max_age(cache_control):
+    """ get the lifetime of an announcement
+
+    :param cache_control: value of the CACHE-CONTROL header (or None)
+    :return: seconds
+    """
+    if cache_control is not None:
+        ma = re.search(r'max-age\s*=\s*(\d+)', cache_control, re.I)
+        if ma is not None:
+            return int(ma.group(1))
+    return DEFAULT_MAX_AGE
+
+class Device:
+    """ one announced device (or service), as little memory as possible
+    """
+    __slots__ = ('usn', 'location', 'server', 'nt', 'expires')
+
+    def __init__(self, usn, location, server, nt, expires):
+        self.usn = usn
+        self.location = location
+        # the same few values are repeated for many devices
+        self.server = server and sys.intern(server)
+        self.nt = nt and sys.intern(nt)
+        self.expires = expires
+
+class Ssdp_registry:
+    """ devices alive right now, keyed by USN
+
+    An entry lives until its max-age runs out without a new announcement,
+    or until a byebye.  The expiry times are kept in a heap; a refreshed
+    device leaves its old heap entry behind, which is skipped when it comes
+    up.  If more than maxsize devices are known, the one not heard of for
+    the longest time is dropped.
+    """
+
+    def __init__(self, maxsize=REGISTRY_SIZE):
+        self.maxsize = maxsize
+        self.devices = collections.OrderedDict()    # usn -> Device, least recently seen first
+        self.heap = []                              # (expires, usn)
+        self.lock = Lock()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.devices)
+
+    def update(self, headers, now=None):
+        """ handle an announcement, byebye or search response
+
+        :param headers: dict as returned by split2dict
+        :param now: current time (default: time.time())
+        :return: 'new', 'alive' (already known), 'byebye' (removed) or None (ignored)
+        """
+        if now is None:
+            now = time.time()
+        usn = headers.get('usn') or headers.get('location')
+        if usn is None:
+            return None
+
+        with self.lock:
+            if headers.get('nts', '').lower() == 'ssdp:byebye':
+                if self.devices.pop(usn, None) is None:
+                    return None
+                return 'byebye'
+
+            location = headers.get('location')
+            if location is None:
+                return None
+            expires = now + max_age(headers.get('cache-control'))
+            heapq.heappush(self.heap, (expires, usn))
+
+            dev = self.devices.get(usn)
+            if dev is not None:
+                dev.location = location
+                dev.expires = expires
+                self.devices.move_to_end(usn)
+                res = 'alive'
+            else:
+                self.devices[usn] = Device(usn, location, headers.get('server'),
+                                           headers.get('nt') or headers.get('st'), expires)
+                res = 'new'
+                while len(self.devices) > self.maxsize:
+                    self.devices.popitem(last=False)
+                    self.evicted += 1
+
+            # too many stale entries from refreshed devices
+            if len(self.heap) > 2 * len(self.devices) + 64:
+                self.heap = [(d.expires, d.usn) for d in self.devices.values()]
+                heapq.heapify(self.heap)
+        return res
+
+    def expire(self, now=None):
+        """ remove the devices whose max-age has run out
+
+        :param now: current time (default: time.time())
+        :return: list of removed Device
+        """
+        if now is None:
+            now = time.time()
+        gone = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                expires, usn = heapq.heappop(self.heap)
+                dev = self.devices.get(usn)
+                if (dev is not None) and dev.expires == expires:
+                    del self.devices[usn]
+                    gone.append(dev)
+        return gone
+
+    def locations(self):
+        """ :return: sorted list of the locations of the devices alive
+        """
+        with self.lock:
+            return sorted(set([d.location for d in self.devices.values()]))
+
 class Scan_for_ssdp(Thread):
-    def __init__(self, mcast_grp, mcast_port, timeout=3, verbose=False):
+    def __init__(self, mcast_grp, mcast_port, registry, timeout=3, verbose=False):
         """
         :param mcast_grp: '': all mcast on port, or specific: e.g. '239.255.255.250'
         :param mcast_port: multicast port
+        :param registry: Ssdp_registry for the devices found
         :param timeout: delay between tries
         :param verbose: more info
         :return:
         """
         Thread.__init__(self)
         self.verbose = verbose
+        self.registry = registry
 
         # define listening socket
         # s.a. http://stackoverflow.com/questions/603852/multicast-in-python
@@ -50,14 +173,14 @@ class Scan_for_ssdp(Thread):
         self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
 
     def run(self):
-        global result_list, result_list_lock
         global request_end
 
         count_timeouts = 0
         count_errors = 0
-        count_locations = 0
 
         while not request_end:
+            for dev in self.registry.expire():
+                print('<< expired:', dev.location)
             dt = None
             try:
                 dt = self.sock.recv(1024)
@@ -81,16 +204,13 @@ class Scan_for_ssdp(Thread):
                     print(s.splitlines()[0])
                 if s.startswith('NOTIFY * HTTP') or s.startswith('HTTP/1.1 200 '):
                     r = split2dict(s)
-                    if 'location' in r:
-                        with result_list_lock:
-                            loc = r['location']
-                            server = r.get('server')
-                            if not loc in result_list:
-                                result_list.append(loc)
-                                count_locations += 1
-                        print('>> location:', loc)
-                        if server is not None:
-                            print(' > server:', server)
+                    state = self.registry.update(r)
+                    if state == 'byebye':
+                        print('<< byebye:', r['usn'])
+                    elif state is not None:
+                        print('>> location:', r['location'])
+                        if r.get('server') is not None:
+                            print(' > server:', r['server'])
 
             except socket.timeout:
                 count_timeouts += 1
@@ -99,7 +219,8 @@ class Scan_for_ssdp(Thread):
                 if self.verbose:
                     print("decode error")
 
-            print('unique loc. %s, errors %s, timeouts %s' % (count_locations, count_errors, count_timeouts))
+            print('devices alive %s, evicted %s, errors %s, timeouts %s' % (
+                len(self.registry), self.registry.evicted, count_errors, count_timeouts))
 
         self.sock.close()
 
@@ -108,11 +229,17 @@ if __name__ == "__main__":
     parser.add_argument('--verbose',
                         action='store_true',
                         help='include input variables')
+    parser.add_argument('--max-devices',
+                        type=int,
+                        default=REGISTRY_SIZE,
+                        help='maximum number of devices kept (default: %s)' % REGISTRY_SIZE)
 
     args = parser.parse_args()
 
+    registry = Ssdp_registry(args.max_devices)
+
     # start listen thread
-    th = Scan_for_ssdp(MCAST_GRP, MCAST_PORT, timeout=3, verbose=args.verbose)
+    th = Scan_for_ssdp(MCAST_GRP, MCAST_PORT, registry, timeout=3, verbose=args.verbose)
     th.start()
 
     # wait for the user to end the scan
@@ -124,10 +251,11 @@ if __name__ == "__main__":
     th.join()
 
     # show the result
+    registry.expire()
+    result_list = registry.locations()
     if len(result_list)==0:
         print('*** No locations found')
     else:
-        result_list.sort()
         print("Locations found:")
         print("================")
         for ele in result_list:
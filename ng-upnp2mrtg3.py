@@ -20,10 +20,29 @@
 global_debug = None         # will be set by command line parameter
 
 import socket
+import errno
 import re
 import argparse
 import collections
 import datetime
+import time
+import os
+import json
+import fcntl
+import configparser
+import shlex
+import hashlib
+import bisect
+import array
+import ipaddress
+import sys
+import struct
+import zlib
+import threading
+import signal
+import xml.parsers.expat
+# asyncio, http.server and xml.etree are imported by the functions using
+# them, loading them would take longer than a single poll from MRTG
 
 def dhms(s):
     """ convert integer uptime to human readable form
@@ -52,8 +71,30 @@ def archer_uptime_conv(s):
     """
     # string returned by archer modem: "103 Days, 12:49:51"
     # not much to do here
+    if s is None:
+        return none2unknown(s)
+    if type(s) is int:
+        # extrapolated uptime (--uptime-every), same form as the modem
+        return dhms(s)
     return s.lower() + ' h'
 
+def uptime_seconds(s):
+    """ get uptime in seconds from the answer of the device
+
+    :param s: "12345" or "103 Days, 12:49:51" (archer)
+    :return: integer or None if the format is unknown
+    """
+    if s is None:
+        return None
+    v = my_int(s)
+    if v is not None:
+        return v
+    match = re.match(r'^\s*(\d+)\s+days?,\s*(\d+):(\d+):(\d+)', s, re.IGNORECASE)
+    if match is None:
+        return None
+    day, ho, min, sec = [int(x) for x in match.groups()]
+    return ((day * 24 + ho) * 60 + min) * 60 + sec
+
 def none2unknown(val):
     """ return value or "UNKNOWN" if value is None
 
@@ -87,11 +128,36 @@ def get_response_code(msg):
     if msg is None:
         return None
 
-    match = re.match('^HTTP/1\.[0|1]\s+(\d+)',msg)
+    match = re.match(r'^HTTP/1\.[0|1]\s+(\d+)',msg)
     if match is None:
         return None
     return int(match.group(1))
 
+def scan_headers(head):
+    """ get the headers of a HTTP message
+
+    :param head: status line and headers
+    :return: dict of headers with lower case names
+    """
+    res = {}
+    for line in head.splitlines()[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            res[name.strip().lower()] = value.strip()
+    return res
+
+def host_header(host, port):
+    """ value of the HOST header
+
+    :return: "host:port", IPv6 addresses in brackets (without zone), e.g. "[fe80::1]:49000"
+    """
+    try:
+        if ipaddress.ip_address(host.split('%')[0]).version == 6:
+            host = '[%s]' % host.split('%')[0]
+    except ValueError:
+        pass        # host name
+    return '%s:%s' % (host, port)
+
 def gettag(answer, tag):
     """ get contents of result tag in answer
 
@@ -117,16 +183,605 @@ def gettag(answer, tag):
 
     return answer[po1:po2]
 
-def find_router(short_id):
-    """ find the router matching the short_id
+def gettags(answer, tag):
+    """ get contents of one or more result tags in answer
 
-    :param short_id: name of router
-    :return: Router collection or None if not found
+    :param answer: SOAP answer
+    :param tag: single tag or tuple of tags
+    :return: content or tuple of contents (None for missing tags)
     """
-    for dt in ROUTERS:
-        if dt.short_id == short_id:
-            return dt
-    return None
+    if type(tag) is tuple:
+        return tuple([gettag(answer, t) for t in tag])
+    return gettag(answer, tag)
+
+class UpnpError(Exception):
+    """ the router did not answer as expected """
+    pass
+
+class Soap_fault(UpnpError):
+    """ the router answered with a SOAP fault
+
+    Attributes: code (HTTP status), faultcode, faultstring,
+    error_code and error_description (UPnPError, if given)
+    """
+
+    def __init__(self, code, fault):
+        self.code = code
+        self.faultcode = fault.get('faultcode')
+        self.faultstring = fault.get('faultstring')
+        self.error_code = my_int(fault.get('errorCode'))
+        self.error_description = fault.get('errorDescription')
+        UpnpError.__init__(self, str(self))
+
+    def __str__(self):
+        if self.error_code is not None:
+            return "UPnPError %s: %s (HTTP %s)" % (self.error_code, self.error_description, self.code)
+        if self.faultstring is not None:
+            return "%s: %s (HTTP %s)" % (self.faultcode, self.faultstring, self.code)
+        return "HTTP %s" % (self.code,)
+
+# conversion of the UPnP data types, all others are kept as string
+UPNP_TYPES = {
+    'ui1': int, 'ui2': int, 'ui4': int, 'ui8': int,
+    'i1': int, 'i2': int, 'i4': int, 'i8': int, 'int': int,
+    'boolean': lambda s: s.strip().lower() in ('1', 'true', 'yes'),
+}
+
+# elements of a SOAP fault
+FAULT_FIELDS = ('faultcode', 'faultstring', 'errorCode', 'errorDescription')
+
+class Soap_parser:
+    """ Parse the answer to a SOAP request while it arrives
+
+    feed() is called with each piece of the answer and returns True as soon
+    as all requested out-arguments have been found, so the rest of the
+    answer need not be read.  Error answers are read completely to decode
+    the SOAP fault.
+    """
+
+    def __init__(self, tag, types=None, keep=False):
+        """ initialize
+
+        :param tag: single tag or tuple of tags to extract
+        :param types: UPnP data type (or tuple of types) of the tags, None: string
+        :param keep: keep the complete answer in self.raw
+        """
+        self.single = type(tag) is not tuple
+        self.tags = (tag,) if self.single else tag
+        if types is None:
+            types = (None,) * len(self.tags)
+        elif type(types) is not tuple:
+            types = (types,)
+        self.types = dict(zip(self.tags, types))
+
+        self.raw = bytearray() if keep else None
+        self.head = b''
+        self.code = None            # HTTP status, known after the header
+        self.headers = {}
+        self.values = {}
+        self.fault = {}
+        self.done = False
+
+        self.current = None
+        self.text = []
+        self.expat = xml.parsers.expat.ParserCreate()
+        self.expat.StartElementHandler = self.start_element
+        self.expat.EndElementHandler = self.end_element
+        self.expat.CharacterDataHandler = self.character_data
+
+    def feed(self, data):
+        """ parse the next part of the answer
+
+        :param data: bytes
+        :return: True if the answer is complete enough
+        """
+        if self.raw is not None:
+            self.raw += data
+        if self.done:
+            return True
+
+        if self.code is None:
+            self.head += data
+            pos = self.head.find(b'\r\n\r\n')
+            if pos < 0:
+                return False
+            head = self.head[:pos].decode('latin-1')
+            self.code = get_response_code(head) or 0
+            self.headers = scan_headers(head)
+            data = self.head[pos + 4:]
+            self.head = None
+
+        if data:
+            try:
+                self.expat.Parse(data, False)
+            except xml.parsers.expat.ExpatError:
+                self.done = True        # nothing more to get from this answer
+        return self.done
+
+    def start_element(self, name, attrs):
+        local = name.rpartition(':')[2]
+        if (local in self.types) or (local in FAULT_FIELDS):
+            self.current = local
+            self.text = []
+
+    def character_data(self, data):
+        if self.current is not None:
+            self.text.append(data)
+
+    def end_element(self, name):
+        local = name.rpartition(':')[2]
+        if local != self.current:
+            return
+        self.current = None
+        value = ''.join(self.text)
+
+        if self.code == 200:
+            if local in self.types:
+                conv = UPNP_TYPES.get(self.types[local])
+                if conv is not None:
+                    try:
+                        value = conv(value)
+                    except ValueError:
+                        value = None
+                self.values[local] = value
+                if len(self.values) == len(self.tags):
+                    self.done = True
+        elif local in FAULT_FIELDS:
+            self.fault[local] = value
+
+    def result(self):
+        """ get the values of the tags
+
+        :return: value or tuple of values (None for missing tags)
+        """
+        if self.single:
+            return self.values.get(self.tags[0])
+        return tuple([self.values.get(t) for t in self.tags])
+
+    def error(self):
+        """ get the error of the answer
+
+        :return: None, UpnpError or Soap_fault
+        """
+        if self.code is None:
+            return UpnpError("incomplete answer")
+        if self.code == 200:
+            return None
+        return Soap_fault(self.code, self.fault)
+
+class Digest_auth:
+    """ HTTP digest authentication (RFC 2617), as required by TR-064
+
+    The last challenge (realm, nonce, ...) of each device is remembered, so
+    requests are sent with authorization right away instead of waiting for
+    the 401 answer every time.  With a Sample_cache the challenge is shared
+    with later invocations.
+    """
+
+    def __init__(self, user, password, cache=None):
+        """ initialize
+
+        :param user: user name
+        :param password: password
+        :param cache: Sample_cache to keep the challenges in (or None)
+        """
+        self.user = user
+        self.password = password
+        self.cache = cache
+        self.challenges = {}        # (host, port) -> dict of the challenge and nc
+
+    def key(self, host, port):
+        return (host, port, 'digest', self.user)
+
+    def get_challenge(self, host, port):
+        ch = self.challenges.get((host, port))
+        if (ch is None) and (self.cache is not None):
+            entry = self.cache.load(self.cache.filename(self.key(host, port)))
+            if entry is not None:
+                ch = entry[1]
+                self.challenges[(host, port)] = ch
+        return ch
+
+    def challenge(self, host, port, header):
+        """ remember a challenge sent by the device
+
+        :param host: host name of UPNP server
+        :param port: port of UPNP server
+        :param header: WWW-Authenticate header of the 401 answer
+        :return: True if it is a new digest challenge worth another try
+        """
+        if (header is None) or not header.lower().startswith('digest'):
+            return False
+        ch = {'nc': 0}
+        for name, quoted, plain in re.findall('(\\w+)=(?:"([^"]*)"|([^,\\s]+))', header[6:]):
+            ch[name.lower()] = quoted or plain
+
+        old = self.get_challenge(host, port)
+        if (old is not None) and old.get('nonce') == ch.get('nonce'):
+            return False        # our credentials have been rejected
+        self.challenges[(host, port)] = ch
+        self.store(host, port)
+        return True
+
+    def store(self, host, port):
+        if self.cache is not None:
+            self.cache.store(self.cache.filename(self.key(host, port)), self.challenges[(host, port)])
+
+    def authorization(self, host, port, method, uri):
+        """ create the Authorization header for a request
+
+        :param host: host name of UPNP server
+        :param port: port of UPNP server
+        :param method: HTTP method
+        :param uri: path of the request
+        :return: header value or None if no challenge is known yet
+        """
+        ch = self.get_challenge(host, port)
+        if ch is None:
+            return None
+
+        def md5(s):
+            return hashlib.md5(s.encode('utf-8')).hexdigest()
+
+        ha1 = md5('%s:%s:%s' % (self.user, ch.get('realm', ''), self.password))
+        ha2 = md5('%s:%s' % (method, uri))
+        res = 'Digest username="%s", realm="%s", nonce="%s", uri="%s", algorithm=MD5' % (
+            self.user, ch.get('realm', ''), ch.get('nonce', ''), uri)
+
+        if 'auth' in ch.get('qop', '').split(','):
+            ch['nc'] += 1
+            self.store(host, port)
+            nc = '%08x' % ch['nc']
+            cnonce = os.urandom(8).hex()
+            response = md5('%s:%s:%s:%s:auth:%s' % (ha1, ch['nonce'], nc, cnonce, ha2))
+            res += ', qop=auth, nc=%s, cnonce="%s"' % (nc, cnonce)
+        else:
+            response = md5('%s:%s:%s' % (ha1, ch.get('nonce', ''), ha2))
+        res += ', response="%s"' % response
+
+        if 'opaque' in ch:
+            res += ', opaque="%s"' % ch['opaque']
+        return res
+
+def read_credentials(filename):
+    """ read user name and password
+
+    :param filename: file containing "user:password" (first line)
+    :return: (user, password)
+    :raises ValueError: if the file may be read by others or is malformed
+    """
+    if os.stat(filename).st_mode & 0o077:
+        raise ValueError("%s must only be accessible by its owner (chmod 600)" % filename)
+    line = open(filename, 'r').readline().rstrip('\r\n')
+    user, sep, password = line.partition(':')
+    if not sep:
+        raise ValueError("%s: expected user:password" % filename)
+    return user, password
+
+#############################################################
+# address resolution
+#
+# The host names of the devices are resolved once and the addresses kept
+# for RESOLVE_TTL seconds, failed lookups for RESOLVE_NEGATIVE_TTL seconds
+# (getaddrinfo does not tell the TTL of the DNS answer).  Connections race
+# the addresses of both families (happy eyeballs, RFC 8305): the next
+# address is tried if the previous one has not connected within
+# CONNECT_DELAY seconds.  The family which connected is tried first next time.
+
+# seconds the addresses of a host name are kept
+RESOLVE_TTL = 300
+
+# seconds a failed lookup is kept
+RESOLVE_NEGATIVE_TTL = 30
+
+# seconds before the next address is tried while a connect is pending
+CONNECT_DELAY = 0.25
+
+class Resolver:
+    """ cached addresses of the devices and the family which worked
+    """
+
+    def __init__(self, ttl=RESOLVE_TTL, negative_ttl=RESOLVE_NEGATIVE_TTL):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}       # (host, port) -> (expiry, list of (family, sockaddr) or socket.gaierror)
+        self.preferred = {}     # host -> family of the last connection
+
+    def cached(self, host, port, now=None):
+        """ :return: addresses as by resolve or None if not cached
+        :raises socket.gaierror: if the lookup failed recently
+        """
+        if now is None:
+            now = time.monotonic()
+        entry = self.entries.get((host, port))
+        if (entry is None) or entry[0] < now:
+            return None
+        if isinstance(entry[1], socket.gaierror):
+            raise entry[1]
+        return self.order(host, entry[1])
+
+    def remember(self, host, port, infos, error=None):
+        """ keep the result of getaddrinfo
+
+        :return: addresses as by resolve
+        :raises socket.gaierror: error, if given
+        """
+        if error is not None:
+            self.entries[(host, port)] = time.monotonic() + self.negative_ttl, error
+            raise error
+        addrs = []
+        for family, socktype, proto, canonname, sockaddr in infos:
+            if (family, sockaddr) not in addrs:
+                addrs.append((family, sockaddr))
+        if global_debug:
+            print('resolved %s: %s' % (host, ' '.join([a[1][0] for a in addrs])))
+        self.entries[(host, port)] = time.monotonic() + self.ttl, addrs
+        return self.order(host, addrs)
+
+    def order(self, host, addrs):
+        """ sort the addresses for connecting: the preferred family first,
+            then alternating between the families
+        """
+        first = self.preferred.get(host, addrs[0][0])
+        same = [a for a in addrs if a[0] == first]
+        other = [a for a in addrs if a[0] != first]
+        res = []
+        for i in range(max(len(same), len(other))):
+            res += same[i:i + 1] + other[i:i + 1]
+        return res
+
+    def resolve(self, host, port):
+        """ get the addresses of a host
+
+        :return: list of (family, sockaddr) in the order to try them
+        :raises socket.gaierror: if the host name is unknown
+        """
+        addrs = self.cached(host, port)
+        if addrs is not None:
+            return addrs
+        try:
+            infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except socket.gaierror as msg:
+            return self.remember(host, port, None, msg)
+        return self.remember(host, port, infos)
+
+    async def resolve_async(self, host, port):
+        """ see resolve
+        """
+        import asyncio
+
+        addrs = self.cached(host, port)
+        if addrs is not None:
+            return addrs
+        try:
+            infos = await asyncio.get_event_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except socket.gaierror as msg:
+            return self.remember(host, port, None, msg)
+        return self.remember(host, port, infos)
+
+    def connected(self, host, family):
+        self.preferred[host] = family
+
+    def failed(self, host, port):
+        """ no address could be connected, look the host up again next time
+        """
+        self.entries.pop((host, port), None)
+
+    def connect(self, host, port, timeout=None):
+        """ connect to the first address of host answering
+
+        :param timeout: seconds for all attempts (default: DEFAULT_TIMEOUT)
+        :return: connected socket (blocking)
+        :raises OSError: if no address could be connected
+        """
+        import selectors
+
+        addrs = self.resolve(host, port)
+        deadline = time.monotonic() + (timeout or DEFAULT_TIMEOUT)
+        selector = selectors.DefaultSelector()
+        pending = {}            # socket -> family
+        error = None
+        next_try = 0
+        try:
+            while addrs or pending:
+                now = time.monotonic()
+                if now >= deadline:
+                    error = socket.timeout('timed out')
+                    break
+                if addrs and (now >= next_try or not pending):
+                    family, sockaddr = addrs.pop(0)
+                    s = socket.socket(family, socket.SOCK_STREAM)
+                    s.setblocking(False)
+                    err = s.connect_ex(sockaddr)
+                    if err in (0, errno.EINPROGRESS):
+                        selector.register(s, selectors.EVENT_WRITE)
+                        pending[s] = family
+                    else:
+                        error = OSError(err, os.strerror(err))
+                        s.close()
+                    next_try = now + CONNECT_DELAY
+                    continue
+
+                wait = deadline - now
+                if addrs:
+                    wait = min(wait, next_try - now)
+                for key, events in selector.select(wait):
+                    s = key.fileobj
+                    selector.unregister(s)
+                    family = pending.pop(s)
+                    err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        s.setblocking(True)
+                        self.connected(host, family)
+                        return s
+                    error = OSError(err, os.strerror(err))
+                    s.close()
+        finally:
+            for s in pending:
+                s.close()
+            selector.close()
+
+        self.failed(host, port)
+        raise error
+
+    async def open_connection(self, host, port):
+        """ asyncio version of connect, the caller limits the time
+
+        :return: (StreamReader, StreamWriter)
+        """
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+
+        async def attempt(family, sockaddr):
+            s = socket.socket(family, socket.SOCK_STREAM)
+            s.setblocking(False)
+            try:
+                await loop.sock_connect(s, sockaddr)
+            except BaseException:
+                s.close()
+                raise
+            return s, family
+
+        addrs = await self.resolve_async(host, port)
+        pending = set()
+        error = None
+        winner = None
+        try:
+            while winner is None and (addrs or pending):
+                if addrs:
+                    pending.add(asyncio.ensure_future(attempt(*addrs.pop(0))))
+                done, pending = await asyncio.wait(pending, timeout=CONNECT_DELAY if addrs else None,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif winner is None:
+                        winner = task.result()
+                    else:
+                        task.result()[0].close()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if winner is None:
+            self.failed(host, port)
+            raise error
+        s, family = winner
+        self.connected(host, family)
+        return await asyncio.open_connection(sock=s)
+
+# addresses of the devices polled by this process
+default_resolver = Resolver()
+
+#############################################################
+# transports
+#
+# Upnpclient sends its requests through a transport.  Besides the socket
+# transport there is a recorder, which writes all exchanges into a capture
+# file, and a replay transport, which answers from such a file.  Each line
+# of a capture file is a JSON object:
+#
+#    {"host": ..., "port": ..., "time": unix time of the request,
+#     "request": text, "response": [[seconds since the request, text], ...]}
+#
+# Texts are bytes decoded as latin-1.
+
+class Socket_transport:
+    """ exchange a request with the device over TCP
+    """
+
+    def __init__(self, resolver=None):
+        """
+        :param resolver: Resolver (default: default_resolver)
+        """
+        self.resolver = resolver or default_resolver
+
+    def exchange(self, host, port, request):
+        """ send a request and receive the answer
+
+        :param host: host name
+        :param port: port number
+        :param request: bytes
+        :return: iterator over the chunks of the answer (bytes), the
+                 connection is closed when the iterator is closed
+        """
+        s = self.resolver.connect(host, port)
+        try:
+            s.send(request)
+            while True:
+                data = s.recv(1024)                 # receive up to 1K bytes
+                if len(data) == 0:
+                    break
+                yield data
+        finally:
+            s.close()
+
+class Recording_transport:
+    """ pass exchanges to another transport and append them to a capture file
+    """
+
+    def __init__(self, transport, filename):
+        self.transport = transport
+        self.filename = filename
+
+    def exchange(self, host, port, request):
+        start = time.time()
+        chunks = []
+        try:
+            for data in self.transport.exchange(host, port, request):
+                chunks.append([round(time.time() - start, 6), data.decode('latin-1')])
+                yield data
+        finally:
+            # also the part read before the caller stopped or an error
+            line = json.dumps({'host': host, 'port': port, 'time': start,
+                               'request': request.decode('latin-1'), 'response': chunks})
+            f = open(self.filename, 'a')
+            f.write(line + '\n')
+            f.close()
+
+def capture_key(request):
+    """ the part of a request identifying the answer
+
+    :param request: text of the request
+    :return: request without the headers changing between runs (HOST, AUTHORIZATION)
+    """
+    return re.sub('(?im)^(host|authorization):.*\r?\n', '', request)
+
+class Replay_transport:
+    """ answer requests from a capture file
+
+    Identical requests are answered with the recorded answers in turn,
+    starting again with the first when all have been used.  The host is
+    not compared, so a capture can be replayed against any address.
+    """
+
+    def __init__(self, filename, speed=1.0):
+        """
+        :param filename: capture file written by Recording_transport
+        :param speed: speed-up factor for the recorded timing, 0: no delays
+        """
+        self.speed = speed
+        self.answers = {}           # key -> [index of next answer, answers]
+        for line in open(filename, 'r'):
+            if line.strip():
+                rec = json.loads(line)
+                self.answers.setdefault(capture_key(rec['request']), [0, []])[1].append(rec['response'])
+
+    def exchange(self, host, port, request):
+        entry = self.answers.get(capture_key(request.decode('latin-1')))
+        if entry is None:
+            raise ConnectionRefusedError("no recorded answer for this request")
+        response = entry[1][entry[0]]
+        entry[0] = (entry[0] + 1) % len(entry[1])
+
+        start = time.time()
+        for offset, data in response:
+            if self.speed:
+                delay = start + offset / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            yield data.encode('latin-1')
 
 class Upnpclient:
     """ Class to build a SOAP request
@@ -135,109 +790,248 @@ class Upnpclient:
         and extract the desired information
     """
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, cache=None, auth=None, transport=None):
         """ initialize
 
         :param host: host name of UPNP server
         :param port: port of UPNP server
+        :param cache: Sample_cache shared with other invocations (or None)
+        :param auth: Digest_auth for devices requiring authentication (or None)
+        :param transport: Socket_transport (default), Recording_transport or Replay_transport
         """
         self.host = host
         self.port = port
+        self.cache = cache
+        self.auth = auth
+        self.transport = transport or Socket_transport()
+        self.last_error = None
+        self.query_time = None
+
+    def create_message(self, serviceurl, schema, action, args=None, auth=None):
+        # schema is either the service type, e.g. "WANIPConnection:1",
+        # or a full URN, e.g. "urn:dslforum-org:service:WANCommonInterfaceConfig:1"
+        if not schema.startswith('urn:'):
+            schema = "urn:schemas-upnp-org:service:" + schema
+
+        # in-arguments of the action
+        if args:
+            arguments = "".join(["<%s>%s</%s>" % (name, value, name) for name, value in args])
+            call = '<u:%s xmlns:u="%s">%s</u:%s>' % (action, schema, arguments, action)
+        else:
+            call = '<u:%s xmlns:u="%s" />' % (action, schema)
 
-    def create_message(self, serviceurl, schema, action):
         # create the SOAP request
         body="""<?xml version="1.0"?>
     <s:Envelope
         xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"
         s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
     <s:Body>
-       <u:%s xmlns:u="urn:schemas-upnp-org:service:%s" />
+       %s
     </s:Body>
-</s:Envelope>""" % (action, schema)
+</s:Envelope>""" % (call,)
 
         # create the HTTP POST request header
         pream = """POST %s HTTP/1.0
-HOST: %s:%s
+HOST: %s
 CONTENT-LENGTH: %s
 CONTENT-TYPE: text/xml; charset="utf-8"
-SOAPACTION: "urn:schemas-upnp-org:service:%s#%s"
+SOAPACTION: "%s#%s"
+""".replace("\n","\r\n") % (serviceurl, host_header(self.host, self.port), len(body), schema, action)
 
-""".replace("\n","\r\n") % (serviceurl, self.host, self.port, len(body), schema, action)
+        # authorization without waiting for the 401 answer
+        if auth is not None:
+            authorization = auth.authorization(self.host, self.port, 'POST', serviceurl)
+            if authorization is not None:
+                pream += "AUTHORIZATION: %s\r\n" % authorization
+        pream += "\r\n"
 
         return "%s%s" % (pream, body)
 
-    def send(self, cmd):
+    def send(self, cmd, parser=None):
         """ send command to host:port and wait for the answer
 
         :param cmd: HTTP POST with SOAP payload
-        :return: answer from the UPNP server
+        :param parser: Soap_parser fed with the answer, reading stops when it is done
+        :return: answer from the UPNP server (parser if given)
         """
-
-        # create TCP socket and connect to host:port
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((self.host, self.port))
-
-        # send text
-        s.send(cmd.encode('utf-8'))
+        chunks = self.transport.exchange(self.host, self.port, cmd.encode('utf-8'))
 
         # receive answer
         resp = ""
-        while True:
-            data = s.recv(1024)                 # receive up to 1K bytes
-            if len(data) == 0:
-                break
-            resp += data.decode('utf-8')
-        s.close()
-
+        try:
+            for data in chunks:
+                if parser is None:
+                    resp += data.decode('utf-8')
+                elif parser.feed(data):
+                    return parser
+        finally:
+            chunks.close()
+
+        if parser is not None:
+            return parser
         return resp
 
-    def send_command(self, serviceurl, schema, action, tag):
+    def send_command(self, serviceurl, schema, action, tag, args=None, types=None):
         """ send command to router and analyse the result
             returns the value between <tag> and </tag>
             or None on error
 
             tag can be a single string (in this case the function returns a string)
             or a tuple of strings (in this case a tuple of results is returned)
+
+            args is a list of (name, value) tuples for in-arguments of the action
+            types are the UPnP data types of the tags (e.g. "ui4"), values are
+            converted accordingly
+
+            the reason of an error is kept in self.last_error, the time of
+            the query (earlier if cached) in self.query_time
+        """
+        if self.cache is not None:
+            key = (self.host, self.port, action) + tuple(args or ())
+            self.last_error = None
+            self.query_time, value = self.cache.get(key,
+                lambda: self.query(serviceurl, schema, action, tag, args, types))
+            return value
+        self.query_time = time.time()
+        return self.query(serviceurl, schema, action, tag, args, types)
+
+    def query(self, serviceurl, schema, action, tag, args=None, types=None):
+        """ send command to router bypassing the cache, see send_command
         """
         global global_debug
 
-        cmd = self.create_message(serviceurl,schema,action)
+        self.last_error = None
+        cmd = self.create_message(serviceurl,schema,action,args,self.auth)
         if global_debug:
             print(cmd)
+
+        if tag is None:
+            # debug: return the complete answer
+            try:
+                return self.send(cmd)
+            except socket.error as msg:
+                print('Socket error:', msg)
+                return None
+
+        parser = Soap_parser(tag, types, keep=global_debug)
         try:
-            res = self.send(cmd)
+            self.send(cmd, parser)
+            if (parser.code == 401) and (self.auth is not None) and \
+                    self.auth.challenge(self.host, self.port, parser.headers.get('www-authenticate')):
+                # no or outdated nonce, try again with the new one
+                if global_debug:
+                    print(parser.raw.decode('utf-8', 'replace'))
+                cmd = self.create_message(serviceurl, schema, action, args, self.auth)
+                if global_debug:
+                    print(cmd)
+                parser = Soap_parser(tag, types, keep=global_debug)
+                self.send(cmd, parser)
         except socket.error as msg:
             print('Socket error:', msg)
+            self.last_error = msg
             return None
         if global_debug:
-            print(res)
+            print(parser.raw.decode('utf-8', 'replace'))
+            print('repsonse code:', parser.code)
 
-        # check return code
-        ret_code = get_response_code(res)
-        if global_debug:
-            print('repsonse code:', ret_code)
-        if ret_code != 200:
+        self.last_error = parser.error()
+        if self.last_error is not None:
+            if global_debug:
+                print('error:', self.last_error)
             return None
 
-        if tag is None:
-            return res  # debug
+        return parser.result()
 
-        if type(tag) is tuple:
-            answer = []
-            for t in tag:
-                answer.append( gettag(res,t) )
-            if global_debug:
-                return answer
-            return tuple(answer)
-        else:
-            if global_debug:
-                return gettag(res,tag)
-            return gettag(res,tag)
+class Sample_cache:
+    """ Results of SOAP requests shared by all invocations on this host
+
+    MRTG queries the same router for several targets, possibly at the same
+    time (Forks).  The first invocation asks the router and stores the result,
+    the others reuse it as long as it is younger than ttl seconds.
+    A lock file per key makes concurrent invocations wait for the first one.
+    """
+
+    def __init__(self, directory, ttl):
+        """ initialize
+
+        :param directory: where to store the results, e.g. /run/ng-upnp2mrtg
+        :param ttl: maximum age of a result in seconds
+        """
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def filename(self, key):
+        """ get the file name for key
+
+        :param key: tuple (host, port, action, ...)
+        :return: full path
+        """
+        name = "_".join([str(k) for k in key])
+        return os.path.join(self.directory, re.sub('[^A-Za-z0-9.:-]', '_', name))
+
+    def load(self, fn):
+        """ get a stored result
+
+        :param fn: file name of the result
+        :return: (time, value) or None if missing
+        """
+        try:
+            f = open(fn, 'r')
+            entry = json.load(f)
+            f.close()
+        except (IOError, ValueError):
+            return None
+        value = entry.get('value')
+        if type(value) is list:
+            value = tuple(value)
+        return entry.get('time', 0), value
+
+    def store(self, fn, value, now=None):
+        """ store a result atomically
+
+        :param fn: file name of the result
+        :param value: result of the query
+        :param now: time of the query (default: now)
+        """
+        if now is None:
+            now = time.time()
+        tmp = "%s.%s" % (fn, os.getpid())
+        f = open(tmp, 'w')
+        json.dump({'time': now, 'value': value}, f)
+        f.close()
+        os.replace(tmp, fn)
+
+    def get(self, key, fetch):
+        """ get a result from the cache or the router
+
+        :param key: tuple (host, port, action, ...)
+        :param fetch: function querying the router
+        :return: (time of the query, result of fetch), maybe cached
+        .note: failed queries (None) are cached as well, so a dead router is
+               not asked again by every target
+        """
+        fn = self.filename(key)
+        lock = open(fn + '.lock', 'w')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entry = self.load(fn)
+            if (entry is not None) and entry[0] >= time.time() - self.ttl:
+                if global_debug:
+                    print('cached:', key, entry[1])
+                return entry
+
+            now = time.time()
+            value = fetch()
+            self.store(fn, value, now)
+            return now, value
+        finally:
+            lock.close()
 
 #############################################################
 # Router definition
 #
-# A list of Router definitions.
+# The Router definitions are read from routers.ini (see there).
 #
 #    short id, used in list_model and as parameter --type
 #    long id, something more descriptive, will be on the output for MRTG
@@ -247,106 +1041,284 @@ SOAPACTION: "urn:schemas-upnp-org:service:%s#%s"
 #    SoapAction for outgoing byte count
 #    SoapAction for uptime request
 #    function pointer to convert uptime into a human readable form
+#    SoapAction for the traffic history (optional, see --history)
+#    event subscription path of WANIPConnection (optional, see --subscribe)
+#    SoapAction for the link capacity in bit/s down and up (optional, see --spikes)
+#    path of the device description with model and firmware (optional, see --properties)
+#    SoapAction for the external IP address (optional, see --properties)
 #
 #  SoapAction:
 #    control path (with leading slash)
-#    service type
+#    service type (or full URN)
 #    service action
 #    tag in answer containing the result
+#    in-arguments as tuple of (name, value) (optional)
+#    UPnP data type of the tag, e.g. "ui4" (optional, default: string)
 #
 Router = collections.namedtuple('Router',
-        ['short_id', 'long_id', 'host', 'port', 'incoming', 'outgoing', 'uptime', 'uptime_conv'])
+        ['short_id', 'long_id', 'host', 'port', 'incoming', 'outgoing', 'uptime', 'uptime_conv',
+         'history', 'events', 'capacity', 'description', 'external_ip'],
+        defaults=(None, None, None, None, None))
 SoapAction = collections.namedtuple('SoapAction',
-        ['path', 'schema', 'action', 'tag'])
-ROUTERS = [
-    Router(
-        # short_id, long_id
-        "nc_premium", "NetCologne Premium",
-        # host, port
-        "192.168.0.1", 49300,
-        # incoming bytes
-        SoapAction(
-            "/WANCommonInterfaceConfigService/control",    # control url
-           "WANCommonInterfaceConfig:1",              # schema
-           "GetTotalBytesReceived",                   # action
-           "NewTotalBytesReceived"),                   # tag
-        # outgoing bytes
-        SoapAction(
-           "/WANCommonInterfaceConfigService/control",
-           "WANCommonInterfaceConfig:1",
-           "GetTotalBytesSent",
-           "NewTotalBytesSent"),
-        # uptime
-        SoapAction(
-           "/WANIPConnectionService/control",
-           "WANIPConnection:1",
-           "GetStatusInfo",
-           "NewUptime"),
-        # function pointer: uptime -> human readable format
-        dhms
-    ),
-    Router(
-        # short_id, long_id
-        "fritzbox_7490", "Fritzbox 7490",
-        # host, port
-        "192.168.178.1", 49000,
-        # incoming bytes
-        SoapAction(
-           "/igdupnp/control/WANCommonIFC1",
-           "WANCommonInterfaceConfig:1",
-           "GetTotalBytesReceived",
-           "NewTotalBytesReceived"),
-        # outgoing bytes
-        SoapAction(
-           "/igdupnp/control/WANCommonIFC1",
-           "WANCommonInterfaceConfig:1",
-           "GetTotalBytesSent",
-           "NewTotalBytesSent"),
-        # uptime
-        SoapAction(
-           "/igdupnp/control/WANIPConn1",   # controlurl
-           "WANIPConnection:1",  # servicetype
-           "GetStatusInfo",
-           "NewUptime"),
-        # function pointer: uptime -> human readable format
-        dhms
-    ),
-    Router(
-        # info contributed by https://github.com/ddiepo
-        # short_id, long_id
-        "archer_c7", "Tp-Link Archer C7",
-        # host, port
-        "192.168.0.1", 49300,
-        # incoming bytes
-        SoapAction(
-           "/ifc",
-           "WANCommonInterfaceConfig:1",
-           "GetTotalBytesReceived",
-           "NewTotalBytesReceived"),
-        # outgoing bytes
-        SoapAction(
-           "/ifc",
-           "WANCommonInterfaceConfig:1",
-           "GetTotalBytesSent",
-           "NewTotalBytesSent"),
-        # uptime
-        SoapAction(
-           "/ipc",                  # controlurl
-           "WANIPConnection:1",  # servicetype
-           "GetStatusInfo",
-           "NewUptime"),
-        archer_uptime_conv
-    )
+        ['path', 'schema', 'action', 'tag', 'args', 'type'], defaults=(None, None))
+
+# functions which may be given as uptime_conv
+UPTIME_CONVERTERS = {
+    'dhms': dhms,
+    'archer_uptime_conv': archer_uptime_conv,
+}
+
+# router definitions, later files add to or override earlier ones
+PROFILE_FILES = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'routers.ini'),
+    '/etc/ng-upnp2mrtg/routers.ini',
+    os.path.expanduser('~/.config/ng-upnp2mrtg/routers.ini'),
 ]
-ROUTERS.append(find_router('fritzbox_7490').
-        _replace(short_id='fritzbox_3370', long_id='Fritzbox 3370'))
-ROUTERS.append(find_router('fritzbox_7490').
-        _replace(short_id='fritzbox_3270', long_id='Fritzbox 3270'))
+
+# compiled router definitions
+PROFILE_CACHE = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+    'ng-upnp2mrtg', 'routers.idx')
+
+# format of the compiled records, the cache is rebuilt if it changes
+PROFILE_VERSION = 5
+
+def parse_soapaction(s):
+    """ convert a SoapAction from a definition file
+
+    :param s: "path schema action tag[:type][,tag[:type]...] [name=value ...]"
+    :return: list [path, schema, action, tag, args, type] (JSON compatible)
+    """
+    fields = s.split()
+    if len(fields) < 4:
+        raise ValueError("SoapAction needs path, schema, action and tag: %s" % s)
+    tag = []
+    types = []
+    for t in fields[3].split(','):
+        name, sep, typ = t.partition(':')
+        tag.append(name)
+        types.append(typ or None)
+    if len(tag) == 1:
+        tag = tag[0]
+        types = types[0]
+    args = None
+    if len(fields) > 4:
+        args = [f.split('=', 1) for f in fields[4:]]
+        if min([len(a) for a in args]) != 2:
+            raise ValueError("in-arguments must be given as name=value: %s" % s)
+    return [fields[0], fields[1], fields[2], tag, args, types]
+
+def compile_profiles(sources):
+    """ read router definitions
+
+    :param sources: list of definition files, missing files are skipped
+    :return: dict short_id -> record (JSON compatible)
+    """
+    config = configparser.ConfigParser(interpolation=None)
+    config.read(sources, encoding='utf-8')
+
+    def values(short_id, seen=()):
+        # resolve "like" recursively
+        section = dict(config[short_id])
+        base = section.pop('like', None)
+        if base is None:
+            return section
+        if (base in seen) or not config.has_section(base):
+            raise ValueError("[%s]: unknown or circular like = %s" % (short_id, base))
+        res = values(base, seen + (short_id,))
+        res.update(section)
+        return res
+
+    records = {}
+    for short_id in config.sections():
+        v = values(short_id)
+        try:
+            if v['uptime_conv'] not in UPTIME_CONVERTERS:
+                raise ValueError("unknown uptime_conv %s" % v['uptime_conv'])
+            records[short_id] = [short_id, v['long_id'], v['host'], int(v['port']),
+                parse_soapaction(v['incoming']), parse_soapaction(v['outgoing']),
+                parse_soapaction(v['uptime']), v['uptime_conv'],
+                parse_soapaction(v['history']) if 'history' in v else None,
+                v.get('events'),
+                parse_soapaction(v['capacity']) if 'capacity' in v else None,
+                v.get('description'),
+                parse_soapaction(v['external_ip']) if 'external_ip' in v else None]
+        except KeyError as msg:
+            raise ValueError("[%s]: missing %s" % (short_id, msg))
+        except ValueError as msg:
+            raise ValueError("[%s]: %s" % (short_id, msg))
+    return records
+
+def record2router(rec):
+    """ convert a compiled record to a Router
+
+    :param rec: list as created by compile_profiles
+    :return: Router
+    """
+    def action(a):
+        if a is None:
+            return None
+        path, schema, name, tag, args, types = a
+        if type(tag) is list:
+            tag = tuple(tag)
+            types = tuple(types)
+        if args is not None:
+            args = tuple([tuple(x) for x in args])
+        return SoapAction(path, schema, name, tag, args, types)
+
+    return Router(rec[0], rec[1], rec[2], rec[3], action(rec[4]), action(rec[5]),
+                  action(rec[6]), UPTIME_CONVERTERS[rec[7]], action(rec[8]), rec[9], action(rec[10]),
+                  rec[11], action(rec[12]))
+
+class Profile_db:
+    """ Router definitions compiled into an indexed file
+
+    The first line of the file holds the index (short_id -> offset, length,
+    long_id) and the state of the source files.  Only the index and the
+    selected record are read, the file is rebuilt if a source file changes.
+    """
+
+    def __init__(self, sources=None, cachefile=PROFILE_CACHE):
+        """ initialize
+
+        :param sources: definition files (default: PROFILE_FILES)
+        :param cachefile: compiled file, None: compile in memory on every run
+        """
+        if sources is None:
+            sources = PROFILE_FILES
+        self.sources = sources
+        self.cachefile = cachefile
+        self.records = None     # only used without cache file
+        self.index = None
+        self.offset = 0         # start of the records in cachefile
+        self.load_index()
+
+    def signature(self):
+        """ get the state of the source files
+
+        :return: list of [file, mtime, size], None for missing files
+        """
+        res = []
+        for fn in self.sources:
+            try:
+                st = os.stat(fn)
+                res.append([fn, st.st_mtime, st.st_size])
+            except OSError:
+                res.append([fn, None, None])
+        return res
+
+    def load_index(self):
+        signature = self.signature()
+        if self.cachefile is not None:
+            try:
+                f = open(self.cachefile, 'rb')
+                header = f.readline()
+                f.close()
+                head = json.loads(header.decode('utf-8'))
+                if (head.get('version') == PROFILE_VERSION) and head['sources'] == signature:
+                    self.index = head['index']
+                    self.offset = len(header)
+                    return
+            except (IOError, ValueError, KeyError):
+                pass
+
+        records = compile_profiles(self.sources)
+        if self.cachefile is not None:
+            try:
+                self.write_cache(signature, records)
+                return self.load_index()
+            except (IOError, OSError):
+                pass        # not writable, keep everything in memory
+        self.records = records
+        self.index = dict([(k, [None, None, r[1]]) for k, r in records.items()])
+
+    def write_cache(self, signature, records):
+        body = []
+        index = {}
+        offset = 0
+        for short_id in sorted(records):
+            rec = json.dumps(records[short_id], separators=(',', ':')).encode('utf-8')
+            index[short_id] = [offset, len(rec), records[short_id][1]]
+            body.append(rec)
+            offset += len(rec)
+        header = json.dumps({'version': PROFILE_VERSION, 'sources': signature, 'index': index},
+                            separators=(',', ':')).encode('utf-8') + b'\n'
+
+        os.makedirs(os.path.dirname(self.cachefile), exist_ok=True)
+        tmp = "%s.%s" % (self.cachefile, os.getpid())
+        f = open(tmp, 'wb')
+        f.write(header + b''.join(body))
+        f.close()
+        os.replace(tmp, self.cachefile)
+
+    def models(self):
+        """ get all routers
+
+        :return: sorted list of (short_id, long_id)
+        """
+        return sorted([(k, v[2]) for k, v in self.index.items()])
+
+    def find(self, short_id):
+        """ find the router matching the short_id
+
+        :param short_id: name of router
+        :return: Router collection or None if not found
+        """
+        entry = self.index.get(short_id)
+        if entry is None:
+            return None
+        if self.records is not None:
+            return record2router(self.records[short_id])
+
+        f = open(self.cachefile, 'rb')
+        f.seek(self.offset + entry[0])
+        rec = json.loads(f.read(entry[1]).decode('utf-8'))
+        f.close()
+        return record2router(rec)
+
+# byte counters of type ui4 wrap around at this value
+COUNTER32 = 2 ** 32
+
+# an uptime lagging behind the elapsed time by more than this (in seconds)
+# means the connection has been re-established since the last poll
+UPTIME_SLACK = 10
+
+# poll at least twice as often as the fastest possible counter wrap
+WRAP_SAFETY = 0.5
+
+# without a known link capacity assume the rate may grow to this multiple
+# of the highest rate observed so far
+RATE_HEADROOM = 4
+
+# a rate above this multiple of the link capacity is a spike (--spikes),
+# the rest is left for the jitter of the poll times
+SPIKE_HEADROOM = 1.1
+
+def limit_delta(delta, elapsed, maxbytes, mode):
+    """ filter the increase of a counter against the link capacity
+
+    :param delta: increase of the counter
+    :param elapsed: seconds since the previous value
+    :param maxbytes: capacity of the link in bytes/s (None: unknown)
+    :param mode: 'reject' (no traffic) or 'clamp' (full capacity)
+    :return: increase to use instead (delta if it is possible)
+    """
+    if (not maxbytes) or (not elapsed) or delta <= maxbytes * elapsed * SPIKE_HEADROOM:
+        return delta
+    if mode == 'clamp':
+        return int(maxbytes * elapsed)
+    return 0
 
 class Nowrap_handler:
     """ Handle wrap-around of counter
 
     The last raw values from the device and the last offsets are stored in a file.
+    A third line holds the time of the last poll and the uptime reported then.
+    It is needed to tell a modulo 2^32 wrap of the counter from a reset.
+    A fourth line (--uptime-every) holds the uptime last queried, the
+    time.monotonic() of that query and the number of polls since.
+    An increase beyond the link capacity (spike) can be rejected or clamped,
+    the offset is then lowered, so the corrected counter continues smoothly.
     """
 
     def __init__(self,filename):
@@ -355,13 +1327,23 @@ class Nowrap_handler:
         self.lastoutraw = None
         self.inoffset = 0
         self.outoffset = 0
+        self.lasttime = None
+        self.lastuptime = None
+        self.uptime = None
+        self.uptime_mono = None
+        self.uptime_polls = 0
+
+        # rates (bytes/s) seen during the last interval, not stored
+        self.inrate = None
+        self.outrate = None
+        self.spikes = 0
 
         try:
             lines = open(filename,'r').readlines()
-            if len(lines) != 2:
+            if len(lines) not in (2, 3, 4):
                 raise ValueError("format mismatch")
 
-            comp = re.compile("^(\d+)\t(\d+)\n$")
+            comp = re.compile(r"^(-?\d+)\t(-?\d+)\n$")
             m1 = comp.match(lines[0])
             m2 = comp.match(lines[1])
             if (m1 is None) or (m2 is None):
@@ -371,42 +1353,172 @@ class Nowrap_handler:
             self.lastoutraw = int(m1.group(2))
             self.inoffset = int(m2.group(1))
             self.outoffset = int(m2.group(2))
+
+            if len(lines) >= 3:
+                m3 = re.match(r"^(\d+)\t(\d+|None)\n$", lines[2])
+                if m3 is not None:
+                    self.lasttime = int(m3.group(1))
+                    self.lastuptime = my_int(m3.group(2), None)
+
+            if len(lines) == 4:
+                m4 = re.match(r"^(\d+)\t(\d+\.?\d*)\t(\d+)\n$", lines[3])
+                if m4 is not None:
+                    self.uptime = int(m4.group(1))
+                    self.uptime_mono = float(m4.group(2))
+                    self.uptime_polls = int(m4.group(3))
         except (IOError, ValueError):
             pass
 
     def __str__(self):
-        return "%s\t%s\n%s\t%s\n" % (self.lastinraw, self  .lastoutraw, \
+        res = "%s\t%s\n%s\t%s\n" % (self.lastinraw, self.lastoutraw, \
             self.inoffset, self.outoffset)
+        if self.lasttime is not None:
+            res += "%d\t%s\n" % (self.lasttime, self.lastuptime)
+            if self.uptime is not None:
+                res += "%d\t%.3f\t%d\n" % (self.uptime, self.uptime_mono, self.uptime_polls)
+        return res
+
+    def reconnected(self, uptime, elapsed):
+        """ check if the connection has been re-established since the last poll
+
+        :param uptime: current uptime in seconds (or None)
+        :param elapsed: seconds since the last poll (or None)
+        :return: True, False or None if unknown
+        """
+        if (uptime is None) or (self.lastuptime is None) or (elapsed is None):
+            return None
+        return uptime < self.lastuptime or uptime + UPTIME_SLACK < elapsed
+
+    def _correct(self, newraw, lastraw, offset, elapsed, reconnected, maxbytes, spikes=None):
+        """ correct a single counter
+
+        :param spikes: None, 'reject' or 'clamp' (see limit_delta)
+        :return: (corrected value, new last raw value, new offset, rate)
+        """
+        if newraw is None:
+            return None, lastraw, offset, None
+        if lastraw is None:
+            return newraw, newraw, offset, None
+
+        if reconnected:
+            # all counters start again at 0 after a reset, even if they
+            # have already passed the last value again
+            offset += lastraw
+            delta = newraw
+        elif newraw >= lastraw:
+            delta = newraw - lastraw
+        else:
+            # 32 bit counters wrap around if the link stays up,
+            # otherwise the counter has been reset
+            if lastraw >= COUNTER32:
+                wrapped = False
+            elif reconnected is None:
+                wrapped = bool(maxbytes and elapsed) and \
+                    newraw + COUNTER32 - lastraw <= maxbytes * elapsed
+            else:
+                wrapped = True
 
-    def get_corr_values(self,newinraw,newoutraw):
+            if wrapped:
+                offset += COUNTER32
+                delta = newraw + COUNTER32 - lastraw
+            else:
+                offset += lastraw
+                delta = newraw
+
+        if spikes is not None:
+            allowed = limit_delta(delta, elapsed, maxbytes, spikes)
+            if allowed != delta:
+                offset -= delta - allowed
+                delta = allowed
+                self.spikes += 1
+
+        rate = None
+        if elapsed:
+            rate = delta / elapsed
+        return newraw + offset, newraw, offset, rate
+
+    def get_corr_values(self, newinraw, newoutraw, uptime=None, now=None, maxbytes=(None, None), spikes=None):
         # - get corrected values
         # - store last values (if not None)
         # - calc new offset
+        #
+        # uptime: uptime in seconds (if known)
+        # now: time of the poll (unix time)
+        # maxbytes: capacity of the link (bytes/s) in and out, if known
+        # spikes: filter increases beyond maxbytes, 'reject' or 'clamp'
 
         newinraw = my_int(newinraw, None)
         newoutraw = my_int(newoutraw, None)
 
-        if self.lastinraw is None:
-            self.lastinraw = newinraw
-        else:
-            if not (newinraw is None):
-                if newinraw < self.lastinraw:
-                    self.inoffset += self.lastinraw
-                self.lastinraw = newinraw
+        elapsed = None
+        if (now is not None) and (self.lasttime is not None) and now > self.lasttime:
+            elapsed = now - self.lasttime
+        reconnected = self.reconnected(uptime, elapsed)
+
+        newinraw, self.lastinraw, self.inoffset, self.inrate = self._correct(
+            newinraw, self.lastinraw, self.inoffset, elapsed, reconnected, maxbytes[0], spikes)
+        newoutraw, self.lastoutraw, self.outoffset, self.outrate = self._correct(
+            newoutraw, self.lastoutraw, self.outoffset, elapsed, reconnected, maxbytes[1], spikes)
+
+        if now is not None:
+            self.lasttime = int(now)
+            self.lastuptime = uptime
+
+        return newinraw, newoutraw
+
+    def extrapolated_uptime(self, newinraw, newoutraw, every, mono):
+        """ uptime without asking the device (--uptime-every)
+
+        :param newinraw: raw incoming byte count of this poll
+        :param newoutraw: raw outgoing byte count of this poll
+        :param every: the device is asked every this many polls
+        :param mono: time.monotonic() now
+        :return: uptime in seconds or None if the device has to be asked
+        .note: a counter going back may be a reconnect, the device is asked then
+        """
+        if (self.uptime is None) or self.uptime_polls + 1 >= every or mono < self.uptime_mono:
+            # nothing cached, due or the poller has been restarted
+            return None
+        for new, last in ((my_int(newinraw), self.lastinraw), (my_int(newoutraw), self.lastoutraw)):
+            if (new is None) or ((last is not None) and new < last):
+                return None
+        return self.uptime + int(mono - self.uptime_mono)
 
-                newinraw += self.inoffset
+    def remember_uptime(self, uptime, queried, mono):
+        """ keep the uptime for extrapolated_uptime
 
-        if self.lastoutraw is None:
-            self.lastoutraw = newoutraw
+        :param uptime: uptime in seconds (or None)
+        :param queried: True if the device has been asked, False if extrapolated
+        :param mono: time.monotonic() now
+        """
+        if not queried:
+            self.uptime_polls += 1
+        elif uptime is None:
+            self.uptime = None
         else:
-            if not (newoutraw is None):
-                if newoutraw < self.lastoutraw:
-                    self.outoffset += self.lastoutraw
-                self.lastoutraw = newoutraw
+            self.uptime = uptime
+            self.uptime_mono = mono
+            self.uptime_polls = 0
 
-                newoutraw += self.outoffset
+    def poll_interval(self, default, maxbytes=(None, None)):
+        """ longest poll interval which still sees every wrap of the counters
 
-        return newinraw, newoutraw
+        :param default: interval to use if no wrap is to be expected
+        :param maxbytes: capacity of the link (bytes/s) in and out, if known
+        :return: interval in seconds
+        .note: counters above 2^32 are 64 bit counters and never wrap
+        """
+        interval = default
+        for raw, rate, cap in ((self.lastinraw, self.inrate, maxbytes[0]),
+                               (self.lastoutraw, self.outrate, maxbytes[1])):
+            if (raw is None) or raw >= COUNTER32:
+                continue
+            fastest = cap
+            if not fastest and rate:
+                fastest = rate * RATE_HEADROOM
+            if fastest:
+                interval = min(interval, WRAP_SAFETY * COUNTER32 / fastest)
+        return interval
 
     def store_info(self):
         f = open(self.filename,'w')
@@ -416,94 +1528,392 @@ class Nowrap_handler:
     def get_offsets(self):
         return self.inoffset, self.outoffset
 
-def list_models(args):
-    """ output nicely formatted list
+# the AVM online monitor returns one value every 5 seconds, the newest first
+HISTORY_STEP = 5
 
-    :param args: dummy parameter (expected by argparse)
-    :return:
+class History_handler:
+    """ Merge the traffic history kept by the device into a file
+
+    Each line holds the time and the downstream and upstream rate (bytes/s).
+    Only samples newer than the last line of the file are appended, so
+    polls overlapping in time do not produce duplicates and the gap after
+    a missed poll is backfilled as far as the history of the device reaches.
     """
-    global ROUTERS
 
-    if len(ROUTERS) == 0:
-        print("No models available")
-        return
+    def __init__(self, filename, step=HISTORY_STEP):
+        self.filename = filename
+        self.step = step
 
-    print("Model id        Description")
-    print("--------        -----------")
+    def last_time(self):
+        """ get the time of the last sample in the file
 
-    for m in ROUTERS:
-        print("%-15s %s" % (m.short_id, m.long_id))
+        :return: unix time or None if the file is empty or missing
+        """
+        try:
+            f = open(self.filename, 'rb')
+            f.seek(0, 2)
+            size = f.tell()
+            f.seek(max(0, size - 256))
+            lines = f.read().decode('utf-8').splitlines()
+            f.close()
+        except IOError:
+            return None
 
-def main():
-    global global_debug
+        for line in reversed(lines):
+            try:
+                stamp = datetime.datetime.strptime(line.split('\t')[0], '%Y-%m-%d %H:%M:%S')
+                return time.mktime(stamp.timetuple())
+            except ValueError:
+                continue
+        return None
 
-    ROUTERS.sort()  # Sort the list by short_id for more readable output
-    all_short_ids = [d.short_id for d in ROUTERS]
+    def merge(self, now, downstream, upstream):
+        """ append new samples
 
-    parser = argparse.ArgumentParser(description='query UPNP router', add_help=False)
-    parser.add_argument('--host', '-h',
-                        help='host ip')
-    parser.add_argument('--port', '-p',
-                        type=int,
-                        help='port number')
-    parser.add_argument('--type', '-t',
-                        choices=all_short_ids,
-                        help='type of router')
-    parser.add_argument('--list', '-l',
-                        action='store_true',
-                        help='list available routers')
-    parser.add_argument('--rawlog',
-                        help='save raw values in this file')
-    parser.add_argument('--nowrap',
-                        help='activate anti-wrap, store status in this file')
-    parser.add_argument('--debug',
-                        action='store_true',
-                        help='display communication')
-    parser.add_argument('--help',                   # as we have disabled it with "add_help=False"
-                        action='help',              # we need to add it manually for "--help"
-                        help='show this help message and exit')
+        :param now: time of the poll (unix time)
+        :param downstream: comma separated rates as returned by the device, newest first
+        :param upstream: dto.
+        :return: number of samples appended
+        """
+        if (downstream is None) or (upstream is None):
+            return 0
+        ds = [my_int(v) for v in downstream.split(',')]
+        us = [my_int(v) for v in upstream.split(',')]
+
+        # the device samples on its own clock, align to the step
+        newest = int(now) // self.step * self.step
+        last = self.last_time()
+
+        lines = []
+        for i in reversed(range(min(len(ds), len(us)))):
+            stamp = newest - i * self.step
+            if (last is not None) and stamp <= last:
+                continue
+            lines.append('%s\t%s\t%s\n' % (
+                datetime.datetime.fromtimestamp(stamp).strftime('%Y-%m-%d %H:%M:%S'),
+                none2unknown(ds[i]), none2unknown(us[i])))
+
+        if lines:
+            f = open(self.filename, 'a')
+            f.write(''.join(lines))
+            f.close()
+        return len(lines)
 
-    args = parser.parse_args()
+# consolidation of MRTG log files: (seconds per entry, number of entries)
+MRTG_BUCKETS = ((300, 600), (1800, 600), (7200, 600), (86400, 732))
 
-    if args.list is True:
-        parser.print_help()
-        print()
-        list_models(None)
-        parser.exit(0)                   # = sys.exit(0)
+class Mrtg_log:
+    """ Write the log file of a target as MRTG (rateup) does
 
-    if args.type is None:
-        print("*** Error: router type not given\n")
-        list_models(args)
-        parser.exit(1)
+    The first line holds the time and the counters of the last poll, the
+    other lines "time avg_in avg_out max_in max_out" (bytes/s), the newest
+    first.  The first of them is the rate since the previous poll, then come
+    600 entries of 5 minutes, 600 of 30 minutes, 600 of 2 hours and 732 of
+    one day.  An entry covers the time from the next (older) entry up to its
+    own time.  At each update the entries are rebuilt from the old ones and
+    the new rate, averages weighted by time, maxima taken from the maxima.
+    """
 
-    global_debug = args.debug
+    def __init__(self, filename, buckets=MRTG_BUCKETS):
+        self.filename = filename
+        self.buckets = buckets
+        self.last = None            # (time, in, out) of the last poll
+        self.entries = []           # (time, avg_in, avg_out, max_in, max_out), newest first
 
-    selected_model = find_router(args.type)
+        try:
+            lines = open(self.filename, 'r').read().splitlines()
+        except IOError:
+            return
+        try:
+            self.last = tuple(int(v) for v in lines[0].split()[:3])
+            for line in lines[1:]:
+                self.entries.append(tuple(int(v) for v in line.split()[:5]))
+        except (IndexError, ValueError):
+            # broken file, start again
+            self.last = None
+            self.entries = []
+
+    @staticmethod
+    def delta(new, last):
+        """ increase of a counter, a counter going back has been reset
+        """
+        if new >= last:
+            return new - last
+        return new
 
-    host = args.host
-    if not host:
-        host = selected_model.host
+    def segments(self, now, inbytes, outbytes):
+        """ the rates as list of (start, end, avg_in, avg_out, max_in, max_out), newest first
+        """
+        segments = []
+        if self.last is not None and now > self.last[0]:
+            dt = now - self.last[0]
+            rin = round(self.delta(inbytes, self.last[1]) / dt)
+            rout = round(self.delta(outbytes, self.last[2]) / dt)
+            segments.append((self.last[0], now, rin, rout, rin, rout))
+        for i in range(len(self.entries) - 1):
+            end, start = self.entries[i][0], self.entries[i + 1][0]
+            if start < end:
+                segments.append((start, end) + self.entries[i][1:])
+        return segments
+
+    def consolidate(self, segments, now):
+        """ build the entries of a new log file
+
+        :param segments: rates, newest first
+        :param now: time of the poll
+        :return: list of entries, newest first
+        """
+        if segments and segments[0][1] == now:
+            first = segments[0][2:]
+        else:
+            first = (0, 0, 0, 0)
+        entries = [(now,) + tuple(first)]
+
+        i = 0
+        end = now
+        for step, count in self.buckets:
+            for n in range(count):
+                # bucket (start, end], the first one of a resolution may be shorter
+                start = (end - 1) // step * step
+                if n == 0 and end == now:
+                    # the time since the last boundary is in the first entry
+                    end = start
+                    start -= step
+                ain = aout = mxin = mxout = 0
+                covered = 0
+                while i < len(segments) and segments[i][0] >= end:
+                    i += 1
+                j = i
+                while j < len(segments) and segments[j][1] > start:
+                    s = segments[j]
+                    overlap = min(end, s[1]) - max(start, s[0])
+                    if overlap > 0:
+                        covered += overlap
+                        ain += s[2] * overlap
+                        aout += s[3] * overlap
+                        mxin = max(mxin, s[4])
+                        mxout = max(mxout, s[5])
+                    j += 1
+                if covered:
+                    ain = round(ain / covered)
+                    aout = round(aout / covered)
+                entries.append((end, ain, aout, mxin, mxout))
+                end = start
+        return entries
+
+    def update(self, now, inbytes, outbytes):
+        """ add a poll and write the file
+
+        :param now: time of the poll (unix time)
+        :param inbytes: incoming counter (corrected by --nowrap, if used)
+        :param outbytes: outgoing counter
+        .note: polls with unknown counters are not written, the next poll
+               then covers the gap with its average
+        """
+        if (inbytes is None) or (outbytes is None):
+            return
+        now = int(now)
+        inbytes = int(inbytes)
+        outbytes = int(outbytes)
+        if (self.last is not None) and now <= self.last[0]:
+            return
+
+        self.entries = self.consolidate(self.segments(now, inbytes, outbytes), now)
+        self.last = (now, inbytes, outbytes)
+
+        tmp = "%s.%s" % (self.filename, os.getpid())
+        f = open(tmp, 'w')
+        f.write('%s %s %s\n' % self.last)
+        f.write(''.join(['%s %s %s %s %s\n' % e for e in self.entries]))
+        f.close()
+        os.replace(tmp, self.filename)
 
-    port = args.port
-    if not port:
-        port = selected_model.port
+#############################################################
+# asyncio interface
+#
+# Import this file as module, e.g.
+#
+#    upnp = importlib.import_module('ng-upnp2mrtg3')
+#    router = upnp.Profile_db().find('fritzbox_7490')
+#    sample = await upnp.poll(router, '192.168.178.1')
+#
 
-    # query the box
-    uc = Upnpclient(host, port)
-    inbytes  = uc.send_command(selected_model.incoming.path, selected_model.incoming.schema,
-            selected_model.incoming.action, selected_model.incoming.tag)
-    outbytes = uc.send_command(selected_model.outgoing.path, selected_model.outgoing.schema,
-            selected_model.outgoing.action, selected_model.outgoing.tag)
-    uptime   = uc.send_command(selected_model.uptime.path, selected_model.uptime.schema,
-            selected_model.uptime.action, selected_model.uptime.tag)
+# seconds to wait for connect and answer
+DEFAULT_TIMEOUT = 10
 
-    uptime_str = selected_model.uptime_conv(uptime)
+Sample = collections.namedtuple('Sample',
+        ['short_id', 'host', 'port', 'time', 'inbytes', 'outbytes', 'uptime', 'error'])
+
+async def query_async(host, port, action, timeout=DEFAULT_TIMEOUT, auth=None, retry=True):
+    """ send a SoapAction and wait for the answer
+
+    :param host: host name of UPNP server
+    :param port: port of UPNP server
+    :param action: SoapAction
+    :param timeout: seconds to wait for connect and answer
+    :param auth: Digest_auth (or None)
+    :param retry: try again if the device sends a new digest challenge
+    :return: content of the tag(s) in the answer
+    :raises UpnpError: on HTTP errors
+    :raises OSError: on network errors (asyncio.TimeoutError on timeout)
+    """
+    import asyncio
+
+    cmd = Upnpclient(host, port).create_message(action.path, action.schema, action.action, action.args, auth)
+    parser = Soap_parser(action.tag, action.type)
+    reader, writer = await asyncio.wait_for(default_resolver.open_connection(host, port), timeout)
+    try:
+        writer.write(cmd.encode('utf-8'))
+        # HTTP/1.0: the server closes the connection after the answer
+        while True:
+            data = await asyncio.wait_for(reader.read(1024), timeout)
+            if len(data) == 0 or parser.feed(data):
+                break
+    finally:
+        writer.close()
+
+    if retry and (parser.code == 401) and (auth is not None) and \
+            auth.challenge(host, port, parser.headers.get('www-authenticate')):
+        return await query_async(host, port, action, timeout, auth, False)
+
+    error = parser.error()
+    if error is not None:
+        raise error
+    return parser.result()
+
+async def poll(router, host=None, port=None, timeout=DEFAULT_TIMEOUT, auth=None):
+    """ query byte counts and uptime of a router
+
+    :param router: Router
+    :param host: host name of UPNP server (default: router.host)
+    :param port: port of UPNP server (default: router.port)
+    :param timeout: seconds to wait for each request
+    :param auth: Digest_auth for devices requiring authentication (or None)
+    :return: Sample, error is None or the first exception raised
+    .note: the requests are sent one after the other, as by main(),
+           so a router never sees more than one connection from us
+    """
+    import asyncio
+
+    host = host or router.host
+    port = port or router.port
+    now = time.time()
+
+    values = []
+    error = None
+    for action in (router.incoming, router.outgoing, router.uptime):
+        try:
+            values.append(await query_async(host, port, action, timeout, auth))
+        except UpnpError as msg:
+            values.append(None)
+            error = error or msg
+        except (OSError, asyncio.TimeoutError) as msg:
+            # the router is unreachable, don't try the other requests
+            values += [None] * (3 - len(values))
+            error = msg
+            break
+
+    return Sample(router.short_id, host, port, now,
+                  my_int(values[0]), my_int(values[1]), values[2], error)
+
+async def poll_many(targets, concurrency=100, timeout=DEFAULT_TIMEOUT):
+    """ poll many routers concurrently
+
+    :param targets: iterable of (router, host, port), host and port may be None
+    :param concurrency: maximum number of routers polled at the same time
+    :param timeout: seconds to wait for each request
+    :return: async iterator of Samples in order of completion
+    .note: targets is consumed lazily, so it may be a generator of any size
+    """
+    import asyncio
+
+    targets = iter(targets)
+    results = asyncio.Queue()
+
+    async def worker():
+        for router, host, port in targets:
+            await results.put(await poll(router, host, port, timeout))
+
+    async def run():
+        try:
+            await asyncio.gather(*[worker() for i in range(concurrency)])
+        finally:
+            await results.put(None)     # end marker
+
+    running = asyncio.ensure_future(run())
+    try:
+        while True:
+            sample = await results.get()
+            if sample is None:
+                break
+            yield sample
+        running.result()        # raise exceptions of the workers
+    finally:
+        running.cancel()
+
+def process_sample(opts, inbytes, outbytes, uptime, now, capacity=(None, None), series=None,
+                   uptime_queried=None, shipping=True):
+    """ correct the counters and log the values as requested
+
+    :param opts: options of the target (nowrap, rawlog, maxbytes1, maxbytes2, interval, mrtglog, spikes,
+                 spool, ship)
+    :param inbytes: raw incoming byte count
+    :param outbytes: raw outgoing byte count
+    :param uptime: uptime as returned by the device
+    :param now: time of the poll (unix time)
+    :param capacity: link capacity (bytes/s) in and out reported by the device,
+                     used if maxbytes1/maxbytes2 are not given, a hint is given if they are lower
+    :param series: name of the series for --spool (see series_name)
+    :param uptime_queried: --uptime-every: True if the uptime came from the device,
+                           False if extrapolated, None: not used
+    :param shipping: ship the spool (--ship), False: the caller does it (see poll_shard)
+    :return: (inbytes, outbytes, comment, interval), comment is appended to long_id,
+             interval is the poll interval needed to see all wraps
+    """
+    # hint for the user in the HTML page if the counters may wrap unnoticed
+    hint = ''
+    interval = opts.interval
+
+    # MRTG ignores rates beyond MaxBytes
+    for name, given, reported in (('MaxBytes1', opts.maxbytes1, capacity[0]), ('MaxBytes2', opts.maxbytes2, capacity[1])):
+        if given and reported and reported > given * SPIKE_HEADROOM:
+            hint += ' (%s below link capacity, use %s)' % (name, reported)
 
     nowrap = None
-    if not(args.nowrap is None):
-        nowrap = Nowrap_handler(args.nowrap)
-        inbytes, outbytes = nowrap.get_corr_values(inbytes,outbytes)
+    if not(opts.nowrap is None):
+        maxbytes = (opts.maxbytes1 or capacity[0], opts.maxbytes2 or capacity[1])
+        nowrap = Nowrap_handler(opts.nowrap)
+        if uptime_queried is not None:
+            nowrap.remember_uptime(uptime_seconds(uptime), uptime_queried, time.monotonic())
+        inbytes, outbytes = nowrap.get_corr_values(inbytes, outbytes,
+                uptime_seconds(uptime), now, maxbytes, opts.spikes)
         nowrap.store_info()
+        if nowrap.spikes:
+            hint += ' (spike %s)' % ('clamped' if opts.spikes == 'clamp' else 'rejected')
+
+        interval = nowrap.poll_interval(opts.interval, maxbytes)
+        if global_debug:
+            print('poll interval needed to see all wraps: %ds' % interval)
+        if interval < opts.interval:
+            hint += ' (poll every %ds)' % interval
+
+    if opts.mrtglog is not None:
+        try:
+            Mrtg_log(opts.mrtglog).update(now, inbytes, outbytes)
+        except IOError as msg:
+            hint += ' (error in MRTG log: %s)' % msg
+
+    if (opts.spool is not None) and (series is not None):
+        offsets = (None, None)
+        if nowrap is not None:
+            offsets = nowrap.get_offsets()
+        try:
+            spool = Sample_spool(opts.spool)
+            spool.add(series, (int(now), my_int(inbytes), my_int(outbytes), uptime_seconds(uptime)) + offsets)
+            if shipping and (opts.ship is not None):
+                spool.ship(opts.ship)
+        except (OSError, ValueError) as msg:
+            hint += ' (shipping failed: %s)' % msg
 
     # store raw data in a file (if requested)
     # give a hint in the output that will displayed in the HTML page
@@ -511,29 +1921,2140 @@ def main():
     # "logindicator" is being appended to the "long_id" string and being displayed in the HTML page created by MRTG.
     # It has no other function other than to send some feedback from this routine to the user
 
-    if args.rawlog is None:
+    if opts.rawlog is None:
         logindicator = ''
     else:
         try:
-            now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            stamp = datetime.datetime.fromtimestamp(now).strftime('%Y-%m-%d %H:%M:%S')
             if nowrap is None:
                 add_info = ''
             else:
                 di, do = nowrap.get_offsets()
                 add_info = '\t%s\t%s' % (di,do)
 
-            f = open(args.rawlog,'a')
-            f.write('%s\t%s\t%s\t%s%s\n' % (now,inbytes,outbytes,uptime,add_info))
+            f = open(opts.rawlog,'a')
+            f.write('%s\t%s\t%s\t%s%s\n' % (stamp,inbytes,outbytes,uptime,add_info))
             f.close()
             logindicator = ' (logged)'
         except IOError:
             logindicator = ' (error during logging)'
 
+    return inbytes, outbytes, logindicator + hint, interval
+
+#############################################################
+# static device properties
+#
+# Model, firmware, link capacity and external address rarely change.  They
+# are kept in a file per device (--properties) and refreshed in the
+# background when older than the ttl, so a poll only asks for the counters.
+#
+#    model        modelName of the device description
+#    firmware     firmware version of the device description
+#    capacity     [downstream, upstream] in bit/s (GetCommonLinkProperties)
+#    external_ip  WAN address (GetExternalIPAddress)
+#
+
+# seconds until the properties are refreshed (--properties-ttl)
+PROPERTIES_TTL = 86400
+
+# seconds until a refresh is tried again if the device did not answer all requests
+PROPERTIES_RETRY = 3600
+
+# tags in the device description holding the firmware version, first found is used
+FIRMWARE_TAGS = ('Display', 'softwareVersion', 'firmwareVersion')
+
+def description_value(xml, tags):
+    """ get the first value of a tag in a device description
+
+    :param xml: device description
+    :param tags: tags to look for, in this order
+    :return: content or None
+    """
+    for tag in tags:
+        match = re.search(r'<%s>\s*([^<]*?)\s*</%s>' % (tag, tag), xml)
+        if match is not None and match.group(1):
+            return match.group(1)
+    return None
+
+async def http_get_async(host, port, path, timeout=DEFAULT_TIMEOUT):
+    """ get a document from the device
+
+    :return: content as string
+    :raises UpnpError: on HTTP errors
+    :raises OSError: on network errors (asyncio.TimeoutError on timeout)
+    """
+    import asyncio
+
+    reader, writer = await asyncio.wait_for(default_resolver.open_connection(host, port), timeout)
+    try:
+        writer.write(("GET %s HTTP/1.0\r\nHOST: %s\r\n\r\n" % (path, host_header(host, port))).encode('utf-8'))
+        data = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+
+    head, sep, body = data.partition(b'\r\n\r\n')
+    code = get_response_code(head.decode('utf-8', 'replace'))
+    if code != 200:
+        raise UpnpError("HTTP %s for %s" % (code, path))
+    return body.decode('utf-8', 'replace')
+
+async def fetch_properties(router, host, port, timeout=DEFAULT_TIMEOUT, auth=None):
+    """ ask the device for its static properties
+
+    :param router: Router, properties without definition are skipped
+    :return: dict of the properties received (see above)
+    """
+    import asyncio
+
+    async def description():
+        xml = await http_get_async(host, port, router.description, timeout)
+        return {'model': description_value(xml, ('modelName',)), 'firmware': description_value(xml, FIRMWARE_TAGS)}
+
+    async def capacity():
+        bits = await query_async(host, port, router.capacity, timeout, auth)
+        if None in bits:
+            return {}
+        return {'capacity': list(bits)}
+
+    async def external_ip():
+        return {'external_ip': await query_async(host, port, router.external_ip, timeout, auth)}
+
+    props = {}
+    for definition, request in ((router.description, description), (router.capacity, capacity),
+                                (router.external_ip, external_ip)):
+        if definition is None:
+            continue
+        try:
+            props.update(await request())
+        except UpnpError as msg:
+            if global_debug:
+                print('properties of %s:%s: %s' % (host, port, msg))
+        except (OSError, asyncio.TimeoutError) as msg:
+            # the device is unreachable, don't try the other requests
+            if global_debug:
+                print('properties of %s:%s: %s' % (host, port, msg))
+            break
+    return dict([(k, v) for k, v in props.items() if v is not None])
+
+def wanted_properties(router):
+    """ :return: set of the properties the device can be asked for
+    """
+    res = set()
+    if router.description is not None:
+        res.add('model')
+    if router.capacity is not None:
+        res.add('capacity')
+    if router.external_ip is not None:
+        res.add('external_ip')
+    return res
+
+def property_label(props):
+    """ properties for the name line, e.g. " [FRITZ!Box 7490, firmware 113.07.29, 203.0.113.7]"
+    """
+    items = []
+    if props.get('model'):
+        items.append(props['model'])
+    if props.get('firmware'):
+        items.append('firmware %s' % props['firmware'])
+    if props.get('external_ip'):
+        items.append(props['external_ip'])
+    if not items:
+        return ''
+    return ' [%s]' % ', '.join(items)
+
+def property_capacity(props):
+    """ :return: link capacity in bytes/s (in, out), (None, None) if unknown
+    """
+    bits = props.get('capacity')
+    if not bits:
+        return None, None
+    return tuple([b // 8 if b else None for b in bits])
+
+class Property_cache:
+    """ static properties of the devices, one file per device
+
+    Expired properties are still used until the refresh has finished.
+    """
+
+    def __init__(self, directory, ttl=PROPERTIES_TTL):
+        """ initialize
+
+        :param directory: where to store the properties, e.g. /var/lib/ng-upnp2mrtg
+        :param ttl: seconds until the properties are refreshed
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.entries = {}       # (host, port) -> (time, properties), read or refreshed by this process
+        os.makedirs(directory, exist_ok=True)
+
+    def filename(self, host, port):
+        return os.path.join(self.directory, re.sub('[^A-Za-z0-9.:-]', '_', "props_%s_%s" % (host, port)))
+
+    def entry(self, host, port):
+        """ :return: (time of the refresh, dict of properties), time 0 if never refreshed
+        """
+        key = (host, port)
+        if key not in self.entries:
+            try:
+                f = open(self.filename(host, port), 'r')
+                data = json.load(f)
+                f.close()
+                self.entries[key] = data['time'], data['properties']
+            except (IOError, ValueError, KeyError):
+                self.entries[key] = 0, {}
+        return self.entries[key]
+
+    def get(self, host, port):
+        """ :return: dict of the properties (maybe expired, empty if unknown)
+        """
+        return self.entry(host, port)[1]
+
+    def expired(self, host, port, now=None):
+        if now is None:
+            now = time.time()
+        return self.entry(host, port)[0] < now - self.ttl
+
+    def store(self, router, host, port, props, now=None):
+        """ store refreshed properties
+
+        :param props: properties received, missing ones are kept from the last refresh
+        .note: if some are missing the next refresh is due after PROPERTIES_RETRY
+        """
+        if now is None:
+            now = time.time()
+        merged = dict(self.get(host, port))
+        merged.update(props)
+        stamp = now
+        if not wanted_properties(router) <= set(props):
+            stamp = min(now, now - self.ttl + PROPERTIES_RETRY)
+        self.entries[(host, port)] = stamp, merged
+
+        fn = self.filename(host, port)
+        tmp = "%s.%s" % (fn, os.getpid())
+        f = open(tmp, 'w')
+        json.dump({'time': stamp, 'properties': merged}, f, sort_keys=True)
+        f.close()
+        os.replace(tmp, fn)
+        return merged
+
+    async def refresh_async(self, router, host, port, timeout=DEFAULT_TIMEOUT, auth=None):
+        """ ask the device and store the properties
+
+        :return: dict of the properties
+        """
+        props = await fetch_properties(router, host, port, timeout, auth)
+        return self.store(router, host, port, props)
+
+    def refresh(self, router, host, port, auth=None):
+        """ refresh unless another process is doing it
+
+        :return: dict of the properties or None if another process is refreshing
+        """
+        import asyncio
+
+        lock = open(self.filename(host, port) + '.lock', 'w')
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None
+            return asyncio.run(self.refresh_async(router, host, port, auth=auth))
+        finally:
+            lock.close()
+
+    def refresh_in_background(self, router, host, port, auth=None):
+        """ refresh in a child process, the caller continues at once
+
+        .note: the child closes stdout, MRTG waits for the end of the output only
+        """
+        sys.stdout.flush()
+        if os.fork() != 0:
+            return
+        try:
+            os.setsid()
+            null = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(null, fd)
+            self.refresh(router, host, port, auth)
+        finally:
+            os._exit(0)
+
+#############################################################
+# sample archive
+#
+# Binary file for large amounts of samples (see helper/archive.py)
+#
+#    magic "UPNPARC1"
+#    blocks (zlib compressed)
+#    index: one entry per block (first time, last time, offset, length, count)
+#    footer: offset of the index, number of blocks, magic "UPNPIDX1"
+#
+# A block holds up to ARCHIVE_BLOCK samples column by column.  Each column
+# is a bitmap of the missing values followed by the first value and the
+# differences to the previous value, zigzag and varint encoded.
+
+ARCHIVE_MAGIC = b'UPNPARC1'
+ARCHIVE_INDEX_MAGIC = b'UPNPIDX1'
+ARCHIVE_ENTRY = struct.Struct('<qqQII')
+ARCHIVE_FOOTER = struct.Struct('<QI8s')
+ARCHIVE_BLOCK = 4096
+
+# a sample: time (unix time), inbytes, outbytes, uptime (seconds), inoffset, outoffset
+ARCHIVE_COLUMNS = 6
+
+def encode_varint(value, out):
+    """ append a signed integer (zigzag, varint) to a bytearray
+    """
+    value = (value << 1) if value >= 0 else ((-value << 1) - 1)
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def decode_varint(buf, pos):
+    """ read a signed integer written by encode_varint
+
+    :return: (value, position after the value)
+    """
+    value = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            break
+        shift += 7
+    return (value >> 1) if not (value & 1) else -((value + 1) >> 1), pos
+
+def encode_column(values, out):
+    """ append a column (list of integers or None) to a bytearray
+    """
+    bitmap = bytearray((len(values) + 7) // 8)
+    last = 0
+    data = bytearray()
+    for i, v in enumerate(values):
+        if v is None:
+            bitmap[i >> 3] |= 1 << (i & 7)
+        else:
+            encode_varint(v - last, data)
+            last = v
+    out += bitmap
+    out += data
+
+def decode_column(buf, pos, count):
+    """ read a column written by encode_column
+
+    :return: (list of values, position after the column)
+    """
+    bitmap = buf[pos:pos + (count + 7) // 8]
+    pos += len(bitmap)
+    values = []
+    last = 0
+    for i in range(count):
+        if bitmap[i >> 3] & (1 << (i & 7)):
+            values.append(None)
+        else:
+            delta, pos = decode_varint(buf, pos)
+            last += delta
+            values.append(last)
+    return values, pos
+
+def encode_block(samples):
+    """ encode samples (tuples of ARCHIVE_COLUMNS integers or None)
+
+    :return: compressed block
+    """
+    out = bytearray()
+    encode_varint(len(samples), out)
+    for column in zip(*samples):
+        encode_column(column, out)
+    return zlib.compress(bytes(out), 9)
+
+def decode_block(block):
+    """ decode a block written by encode_block
+
+    :return: list of samples
+    """
+    buf = zlib.decompress(block)
+    count, pos = decode_varint(buf, 0)
+    columns = []
+    for i in range(ARCHIVE_COLUMNS):
+        column, pos = decode_column(buf, pos, count)
+        columns.append(column)
+    return list(zip(*columns))
+
+class Sample_archive:
+    """ columnar, compressed archive of samples with an index on time
+    """
+
+    def __init__(self, filename):
+        """ open an archive, it is created by the first append
+
+        :param filename: name of the archive
+        :raises ValueError: if the file is not an archive
+        """
+        self.filename = filename
+        self.index = []         # list of (first time, last time, offset, length, count)
+        self.index_offset = len(ARCHIVE_MAGIC)
+
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return
+        try:
+            if f.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+                raise ValueError("%s is not an archive" % filename)
+            f.seek(-ARCHIVE_FOOTER.size, 2)
+            self.index_offset, blocks, magic = ARCHIVE_FOOTER.unpack(f.read(ARCHIVE_FOOTER.size))
+            if magic != ARCHIVE_INDEX_MAGIC:
+                raise ValueError("%s: index missing" % filename)
+            f.seek(self.index_offset)
+            data = f.read(blocks * ARCHIVE_ENTRY.size)
+            self.index = [ARCHIVE_ENTRY.unpack_from(data, i * ARCHIVE_ENTRY.size)
+                          for i in range(blocks)]
+        finally:
+            f.close()
+
+    def __len__(self):
+        return sum([entry[4] for entry in self.index])
+
+    def append(self, samples, blocksize=ARCHIVE_BLOCK):
+        """ append samples (sorted by time, newer than the samples in the archive)
+
+        :param samples: list of tuples (time, inbytes, outbytes, uptime, inoffset, outoffset)
+        :param blocksize: maximum number of samples per block
+        """
+        if not samples:
+            return
+        if not os.path.exists(self.filename):
+            open(self.filename, 'wb').write(ARCHIVE_MAGIC)
+
+        f = open(self.filename, 'r+b')
+        # the new blocks overwrite the old index
+        f.seek(self.index_offset)
+        f.truncate()
+        pos = self.index_offset
+        for i in range(0, len(samples), blocksize):
+            part = samples[i:i + blocksize]
+            block = encode_block(part)
+            f.write(block)
+            self.index.append((part[0][0], part[-1][0], pos, len(block), len(part)))
+            pos += len(block)
+
+        self.index_offset = pos
+        f.write(b''.join([ARCHIVE_ENTRY.pack(*entry) for entry in self.index]))
+        f.write(ARCHIVE_FOOTER.pack(self.index_offset, len(self.index), ARCHIVE_INDEX_MAGIC))
+        f.close()
+
+    def read(self, start=None, end=None):
+        """ get the samples of a time range
+
+        :param start: first time (unix time), None: from the beginning
+        :param end: last time, None: up to the end
+        :return: iterator of samples
+        .note: only the blocks overlapping the time range are read
+        """
+        first = 0
+        if start is not None:
+            first = bisect.bisect_left([entry[1] for entry in self.index], start)
+
+        f = open(self.filename, 'rb')
+        try:
+            for t_first, t_last, offset, length, count in self.index[first:]:
+                if (end is not None) and t_first > end:
+                    break
+                f.seek(offset)
+                for sample in decode_block(f.read(length)):
+                    if (start is not None) and sample[0] < start:
+                        continue
+                    if (end is not None) and sample[0] > end:
+                        break
+                    yield sample
+        finally:
+            f.close()
+
+def parse_rawlog_line(line):
+    """ convert a line written by --rawlog into a sample
+
+    :param line: "time inbytes outbytes uptime [inoffset outoffset]" separated by tabs
+    :return: tuple (time, inbytes, outbytes, uptime, inoffset, outoffset) or None if malformed
+    """
+    fields = line.rstrip('\n').split('\t')
+    if len(fields) not in (4, 6):
+        return None
+    try:
+        stamp = datetime.datetime.strptime(fields[0], '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+    fields += [None, None]
+    return (int(time.mktime(stamp.timetuple())), my_int(fields[1]), my_int(fields[2]),
+            uptime_seconds(fields[3]), my_int(fields[4]), my_int(fields[5]))
+
+def format_rawlog_line(sample):
+    """ convert a sample into a line as written by --rawlog
+
+    :param sample: tuple (time, inbytes, outbytes, uptime, inoffset, outoffset)
+    :return: line
+    """
+    stamp = datetime.datetime.fromtimestamp(sample[0]).strftime('%Y-%m-%d %H:%M:%S')
+    add_info = ''
+    if (sample[4] is not None) or (sample[5] is not None):
+        add_info = '\t%s\t%s' % (sample[4], sample[5])
+    return '%s\t%s\t%s\t%s%s\n' % (stamp, sample[1], sample[2], sample[3], add_info)
+
+#############################################################
+# sample shipping
+#
+# With --spool the samples are appended to a spool file in a local
+# directory.  With --ship they are sent from there to a central collector
+# (helper/collector.py) at most every SHIP_INTERVAL seconds.  A batch is
+# only deleted after the collector has acknowledged it, so the samples
+# survive an outage of the network or the collector.
+#
+# Protocol (TCP): the poller sends SHIP_MAGIC, then one frame per series:
+#    length of the block, length of the name (SHIP_FRAME), name (utf-8),
+#    block (encode_block)
+# and a frame with both lengths 0 at the end.  The collector answers each
+# frame with SHIP_ACK once it is stored (SHIP_NAK on errors).
+
+SHIP_MAGIC = b'UPNPSHP1'
+SHIP_FRAME = struct.Struct('>IH')
+SHIP_ACK = b'+'
+SHIP_NAK = b'-'
+SHIP_INTERVAL = 60
+
+def series_name(host, port):
+    """ name of the series of a router at the collector: "poller/host:port"
+    """
+    return '%s/%s:%s' % (COLLECTD_HOSTNAME, host, port)
+
+class Sample_spool:
+    """ local buffer of samples waiting to be shipped
+
+    New samples are appended to the file "spool" (one line per sample:
+    series and the columns of the sample, separated by tabs).  To ship, the
+    file is renamed to "batch.<time>", so polls can go on appending, and the
+    batch is deleted when the collector has acknowledged it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.spool = os.path.join(directory, 'spool')
+
+    def add(self, series, sample):
+        """ append a sample
+
+        :param series: name of the series
+        :param sample: tuple (time, inbytes, outbytes, uptime, inoffset, outoffset)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        line = '\t'.join([series] + [str(none2unknown(v)) for v in sample]) + '\n'
+        while True:
+            f = open(self.spool, 'a')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                # take() may have renamed the file while we waited for the lock
+                try:
+                    current = os.stat(self.spool).st_ino == os.fstat(f.fileno()).st_ino
+                except FileNotFoundError:
+                    current = False
+                if current:
+                    f.write(line)
+                    return
+            finally:
+                f.close()
+
+    def batches(self):
+        """ :return: names of the batches not yet shipped, oldest first
+        """
+        try:
+            names = os.listdir(self.directory)
+        except IOError:
+            return []
+        return sorted([os.path.join(self.directory, n) for n in names if n.startswith('batch.')])
+
+    def take(self):
+        """ turn the spool file into a batch
+        """
+        try:
+            f = open(self.spool, 'r+')
+        except IOError:
+            return
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            if os.fstat(f.fileno()).st_size > 0:
+                os.replace(self.spool, os.path.join(self.directory, 'batch.%020d' % time.time_ns()))
+        finally:
+            f.close()
+
+    @staticmethod
+    def frames(batch):
+        """ encode a batch
+
+        :param batch: file name
+        :return: list of frames, one per series
+        """
+        series = collections.OrderedDict()
+        for line in open(batch, 'r'):
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == ARCHIVE_COLUMNS + 1:
+                series.setdefault(fields[0], []).append(tuple([my_int(v) for v in fields[1:]]))
+
+        frames = []
+        for name, samples in series.items():
+            name = name.encode('utf-8')
+            block = encode_block(sorted(samples, key=lambda s: s[0]))
+            frames.append(SHIP_FRAME.pack(len(block), len(name)) + name + block)
+        return frames
+
+    def ship(self, address, every=SHIP_INTERVAL):
+        """ send the waiting samples to the collector
+
+        :param address: "host:port" of the collector
+        :param every: minimum seconds between two shipments
+        :return: number of batches shipped, None if it was not yet time
+        :raises OSError: if the collector cannot be reached (the batches are kept)
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        # the time of the last shipment is the mtime of the lock file
+        lockfile = os.path.join(self.directory, 'ship.lock')
+        first = not os.path.exists(lockfile)
+        lock = open(lockfile, 'a')
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another process is shipping
+                return None
+            if (not first) and time.time() - os.fstat(lock.fileno()).st_mtime < every:
+                return None
+            os.utime(lock.fileno())
+
+            self.take()
+            batches = self.batches()
+            if not batches:
+                return 0
+
+            host, sep, port = address.rpartition(':')
+            s = socket.create_connection((host.strip('[]'), int(port)), DEFAULT_TIMEOUT)
+            try:
+                s.sendall(SHIP_MAGIC)
+                shipped = 0
+                for batch in batches:
+                    frames = self.frames(batch)
+                    s.sendall(b''.join(frames))
+                    answer = b''
+                    while len(answer) < len(frames):
+                        data = s.recv(len(frames) - len(answer))
+                        if len(data) == 0:
+                            raise ConnectionError("collector closed the connection")
+                        answer += data
+                    if answer != SHIP_ACK * len(frames):
+                        raise ConnectionError("collector could not store the samples")
+                    os.remove(batch)
+                    shipped += 1
+                s.sendall(SHIP_FRAME.pack(0, 0))
+            finally:
+                s.close()
+            return shipped
+        finally:
+            lock.close()
+
+#############################################################
+# polling many targets with several processes
+#
+# The targets are distributed to the processes by consistent hashing of
+# the host, so the state files of a router are only used by one process.
+# Each process polls its share with poll_many and sends the output lines
+# in batches to the main process.
+
+Target = collections.namedtuple('Target',
+        ['short_id', 'host', 'port', 'nowrap', 'rawlog', 'maxbytes1', 'maxbytes2', 'interval', 'mrtglog',
+         'spikes', 'spool', 'ship', 'credentials'])
+
+# number of output lines sent to the main process at once
+SHARD_BATCH = 256
+
+class Target_table:
+    """ many targets stored column by column
+
+    Numbers are kept in arrays, the profile as index into a list of short
+    ids and the host names interned.  Options set for few targets only
+    (SPARSE) are kept in a dict per option, by row.  A row is handed out
+    as Target when needed, so a target in memory costs little more than
+    its host name and its nowrap file name.
+    """
+    __slots__ = ('profiles', 'short_id', 'host', 'port', 'interval', 'maxbytes1', 'maxbytes2',
+                 'nowrap', 'sparse')
+
+    SPARSE = ('rawlog', 'mrtglog', 'spikes', 'spool', 'ship', 'credentials')
+
+    def __init__(self, targets=()):
+        """
+        :param targets: iterable of Target
+        """
+        self.profiles = []                  # short ids
+        self.short_id = array.array('H')    # index into profiles
+        self.host = []
+        self.port = array.array('H')
+        self.interval = array.array('I')
+        self.maxbytes1 = array.array('q')   # 0: not given
+        self.maxbytes2 = array.array('q')
+        self.nowrap = []
+        self.sparse = dict([(name, {}) for name in self.SPARSE])
+        for t in targets:
+            self.append(t)
+
+    def __len__(self):
+        return len(self.host)
+
+    def __iter__(self):
+        for i in range(len(self.host)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        return Target(self.profiles[self.short_id[i]], self.host[i], self.port[i], self.nowrap[i],
+                      self.sparse['rawlog'].get(i), self.maxbytes1[i] or None, self.maxbytes2[i] or None,
+                      self.interval[i], self.sparse['mrtglog'].get(i), self.sparse['spikes'].get(i),
+                      self.sparse['spool'].get(i), self.sparse['ship'].get(i), self.sparse['credentials'].get(i))
+
+    def append(self, target):
+        """ add a Target
+        """
+        i = len(self.host)
+        if target.short_id not in self.profiles:
+            self.profiles.append(target.short_id)
+        self.short_id.append(self.profiles.index(target.short_id))
+        self.host.append(sys.intern(target.host))
+        self.port.append(target.port)
+        self.interval.append(target.interval)
+        self.maxbytes1.append(target.maxbytes1 or 0)
+        self.maxbytes2.append(target.maxbytes2 or 0)
+        self.nowrap.append(target.nowrap)
+        for name in self.SPARSE:
+            value = getattr(target, name)
+            if value is not None:
+                self.sparse[name][i] = value
+
+    def key(self, i):
+        """ :return: (short id, host, port) of row i, targets with the same key are polled once
+        """
+        return self.profiles[self.short_id[i]], self.host[i], self.port[i]
+
+    def sort(self):
+        """ sort the rows by key in place, one column at a time
+        """
+        # stable sorts from the last to the first part of the key, the sort
+        # keys are objects already there (interned hosts, one int per port)
+        order = list(range(len(self.host)))
+        ports = dict([(p, p) for p in set(self.port)])
+        order.sort(key=lambda i: ports[self.port[i]])
+        order.sort(key=lambda i: self.host[i])
+        order.sort(key=lambda i: self.profiles[self.short_id[i]])
+        order = array.array('I', order)
+
+        for name in ('short_id', 'port', 'interval', 'maxbytes1', 'maxbytes2'):
+            column = getattr(self, name)
+            setattr(self, name, array.array(column.typecode, (column[i] for i in order)))
+        self.host = [self.host[i] for i in order]
+        self.nowrap = [self.nowrap[i] for i in order]
+        for name, values in self.sparse.items():
+            self.sparse[name] = dict([(j, values[i]) for j, i in enumerate(order) if i in values])
+
+
+def read_targets(filename, parser, db):
+    """ read a target file
+
+    :param filename: one target per line, options as on the command line,
+                     e.g. "-t fritzbox_7490 -h 192.168.178.1 --nowrap /var/lib/mrtg/fb.nowrap"
+    :param parser: ArgumentParser for the options
+    :param db: Profile_db to complete host and port
+    :return: Target_table
+    """
+    targets = Target_table()
+    for lineno, line in enumerate(open(filename, 'r'), 1):
+        line = line.strip()
+        if (line == '') or line.startswith('#'):
+            continue
+        targets.append(parse_target(line, parser, db, "%s, line %s" % (filename, lineno)))
+    return targets
+
+def parse_target(line, parser, db, where):
+    """ create a Target from a line of options
+
+    :param line: options as on the command line
+    :param parser: ArgumentParser for the options
+    :param db: Profile_db to complete host and port
+    :param where: position of the line for error messages
+    :return: Target
+    """
+    try:
+        opts = parser.parse_args(shlex.split(line))
+    except SystemExit:
+        print("*** Error in %s" % where)
+        raise
+    if (opts.spikes is not None) and (opts.nowrap is None):
+        parser.error("--spikes needs --nowrap in %s" % where)
+    router = db.find(opts.type)
+    if router is None:
+        parser.error("unknown router type %s in %s" % (opts.type, where))
+    return opts2target(opts, router)
+
+def opts2target(opts, router):
+    """ create a Target from the options of a target
+
+    :param opts: parsed options
+    :param router: Router selected by opts.type
+    :return: Target
+    """
+    return Target(opts.type, opts.host or router.host, opts.port or router.port,
+        opts.nowrap, opts.rawlog, opts.maxbytes1, opts.maxbytes2, opts.interval, opts.mrtglog,
+        opts.spikes, opts.spool, opts.ship, opts.credentials)
+
+def hash_key(key):
+    """ hash value independent of the process (unlike hash())
+
+    :param key: string
+    :return: integer
+    """
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+class Hash_ring:
+    """ consistent hashing of keys to nodes
+
+    Each node is put on the ring several times.  A key belongs to the next
+    node on the ring, so adding or removing a node only moves few keys.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        ring = sorted([(hash_key("%s#%s" % (node, i)), node)
+                       for node in nodes for i in range(replicas)])
+        self.hashes = [h for h, node in ring]
+        self.nodes = [node for h, node in ring]
+
+    def node(self, key):
+        i = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.nodes[i]
+
+# shortest interval used to follow fast wrapping counters
+MIN_INTERVAL = 10
+
+def format_tabs(target, router, sample, inbytes, outbytes, comment):
+    """ output line: "host port inbytes outbytes uptime description" separated by tabs
+    """
+    if sample.uptime is None:
+        uptime_str = none2unknown(None)
+    else:
+        uptime_str = router.uptime_conv(sample.uptime)
+    if sample.error is not None:
+        comment += ' (error: %s)' % (sample.error,)
+    return "%s\t%s\t%s\t%s\t%s\t%s\n" % (target.host, target.port,
+        none2unknown(inbytes), none2unknown(outbytes), uptime_str, router.long_id + comment)
+
+def format_collectd(target, router, sample, inbytes, outbytes, comment):
+    """ output lines for the collectd exec plugin (PUTVAL)
+    """
+    def u(val):
+        if val is None:
+            return 'U'
+        return val
+
+    ident = '%s/upnp-%s_%s' % (COLLECTD_HOSTNAME, target.host, target.port)
+    stamp = int(sample.time)
+    return 'PUTVAL "%s/if_octets" interval=%s %s:%s:%s\nPUTVAL "%s/uptime" interval=%s %s:%s\n' % (
+        ident, target.interval, stamp, u(inbytes), u(outbytes),
+        ident, target.interval, stamp, u(uptime_seconds(sample.uptime)))
+
+def influx_escape(s):
+    """ escape a tag value of the influx line protocol
+    """
+    return re.sub('([, =])', r'\\\1', str(s))
+
+def format_influx(target, router, sample, inbytes, outbytes, comment):
+    """ output line for telegraf (influx line protocol)
+    """
+    fields = []
+    for name, val in (('bytes_recv', inbytes), ('bytes_sent', outbytes),
+                      ('uptime', uptime_seconds(sample.uptime))):
+        if val is not None:
+            fields.append('%s=%si' % (name, val))
+    if not fields:
+        return ''
+    return 'upnp,host=%s,router=%s,port=%s,model=%s %s %d\n' % (
+        influx_escape(COLLECTD_HOSTNAME), influx_escape(target.host), target.port,
+        influx_escape(target.short_id), ','.join(fields), int(sample.time * 1e9))
+
+# output formats of --targets and --stream
+FORMATTERS = {
+    'tabs': format_tabs,
+    'collectd': format_collectd,
+    'influx': format_influx,
+}
+
+# host name in collectd identifiers and the influx host tag
+COLLECTD_HOSTNAME = os.environ.get('COLLECTD_HOSTNAME') or socket.gethostname()
+
+def format_sample(target, router, sample, fmt='tabs', props=None):
+    """ correct and log a sample of a target, create the output line(s)
+
+    :param target: Target
+    :param router: Router
+    :param sample: Sample
+    :param fmt: key of FORMATTERS
+    :param props: static properties of the device (or None)
+    :return: (output, interval needed to see all wraps)
+    .note: the spool is not shipped (--ship), this is left to the caller
+    """
+    props = props or {}
+    inbytes, outbytes, comment, interval = process_sample(target, sample.inbytes, sample.outbytes,
+                                                          sample.uptime, sample.time, property_capacity(props),
+                                                          series=series_name(target.host, target.port),
+                                                          shipping=False)
+    comment = property_label(props) + comment
+    return FORMATTERS[fmt](target, router, sample, inbytes, outbytes, comment), interval
+
+# seconds between two reports of the schedule slip (--stream)
+SLIP_REPORT = 300
+
+# the scheduler keeps each job as one integer: due time in ms and job index
+HEAP_INDEX_BITS = 24
+HEAP_INDEX_MASK = (1 << HEAP_INDEX_BITS) - 1
+
+def subnet_key(host):
+    """ key of the subnet of a host for --subnet-rate
+
+    :param host: IP address or host name
+    :return: "a.b.c.0/24" or "x:x:x:x::/64", host names are their own subnet
+    """
+    try:
+        addr = ipaddress.ip_address(host)
+    except ValueError:
+        return host
+    prefix = 24 if addr.version == 4 else 64
+    return str(ipaddress.ip_network("%s/%s" % (addr, prefix), strict=False))
+
+class Rate_limit:
+    """ token bucket
+
+    Tokens are taken in advance: the bucket may go negative, the caller
+    then has to wait until its token would have been there.
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: tokens per second
+        :param burst: maximum number of tokens saved up
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def take(self):
+        """ take a token
+
+        :return: seconds to wait before using it
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+class Poll_scheduler:
+    """ start polls at their time, spread over the interval and rate limited
+
+    Each job has a phase within its interval derived from its host, so the
+    routers are not all polled at the same moment and each router is always
+    polled at the same offset (steady cadence).  The difference between the
+    planned and the actual start is collected as slip.
+    """
+
+    def __init__(self, concurrency=100, rate=None, subnet_rate=None, spread=True):
+        """
+        :param concurrency: maximum number of polls running at the same time
+        :param rate: maximum number of polls started per second (None: no limit)
+        :param subnet_rate: maximum number of polls per second and subnet (None: no limit)
+        :param spread: use the phase of the hosts, False: start all jobs at once
+        """
+        self.concurrency = concurrency
+        self.spread = spread
+        self.rate = None
+        if rate:
+            self.rate = Rate_limit(rate)
+        self.subnet_rate = subnet_rate
+        self.subnets = {}
+        self.reset_slip()
+
+    def phase(self, host, interval):
+        """ stable offset of a host within the interval
+
+        :return: seconds
+        """
+        if not self.spread:
+            return 0
+        return (hash_key(host) % (interval * 1000)) / 1000
+
+    def first_due(self, host, interval, now):
+        """ first poll time of a host: the next time t with t % interval == phase
+        """
+        phase = self.phase(host, interval)
+        if not self.spread:
+            return now
+        return now - (now - phase) % interval + interval
+
+    def reset_slip(self):
+        self.slip_count = 0
+        self.slip_sum = 0
+        self.slip_max = 0
+
+    def slip_report(self):
+        """ :return: "n polls, slip mean x s, max y s" since the last reset
+        """
+        mean = self.slip_sum / self.slip_count if self.slip_count else 0
+        return "%s polls, slip mean %.2fs, max %.2fs" % (self.slip_count, mean, self.slip_max)
+
+    async def wait_rate(self, host):
+        """ wait until the rate limits allow to poll host
+        """
+        import asyncio
+
+        delay = 0
+        if self.rate is not None:
+            delay = self.rate.take()
+        if self.subnet_rate:
+            key = subnet_key(host)
+            limit = self.subnets.get(key)
+            if limit is None:
+                limit = self.subnets[key] = Rate_limit(self.subnet_rate)
+            delay = max(delay, limit.take())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def heap_entry(due, i):
+        return (int(due * 1000) << HEAP_INDEX_BITS) | i
+
+    @staticmethod
+    def heap_job(entry):
+        """ :return: (due, index) of a heap entry
+        """
+        return (entry >> HEAP_INDEX_BITS) / 1000, entry & HEAP_INDEX_MASK
+
+    def initial_heap(self, hosts, intervals, now):
+        """ the first poll of each job, as heap
+
+        :param hosts: sequence of host names
+        :param intervals: sequence of poll intervals
+        :param now: current time
+        :return: list of heap entries
+        """
+        import heapq
+
+        if len(hosts) > HEAP_INDEX_MASK + 1:
+            raise ValueError("too many targets for one process")
+        heap = [self.heap_entry(self.first_due(hosts[i], intervals[i], now), i) for i in range(len(hosts))]
+        heapq.heapify(heap)
+        return heap
+
+    async def run(self, hosts, intervals, poll, rounds=None, report=None):
+        """ run the polls
+
+        :param hosts: sequence of the host names of the jobs
+        :param intervals: sequence of the poll intervals of the jobs
+        :param poll: coroutine function called with the index of a job,
+                     returns the interval needed from now on (or None)
+        :param rounds: number of polls per job, None: forever
+        :param report: function called with the slip report every SLIP_REPORT seconds (or None)
+        .note: the interval of a job is shortened if poll asks for it, the
+               cadence then continues from the last planned time.  A poll
+               raising an exception is reported on stderr and scheduled again.
+        """
+        import asyncio
+        import heapq
+
+        now = time.time()
+        heap = self.initial_heap(hosts, intervals, now)
+        counts = array.array('I', [0]) * len(hosts)
+        running = set()
+        slots = asyncio.Semaphore(self.concurrency)
+        next_report = now + SLIP_REPORT
+
+        async def start(i, due):
+            try:
+                await self.wait_rate(hosts[i])
+                slip = max(0, time.time() - due)
+                self.slip_count += 1
+                self.slip_sum += slip
+                self.slip_max = max(self.slip_max, slip)
+                needed = await poll(i)
+            except Exception as msg:
+                print("ng-upnp2mrtg3 [%s]: poll of %s failed: %s" % (os.getpid(), hosts[i], msg), file=sys.stderr)
+                needed = None
+            finally:
+                slots.release()
+            counts[i] += 1
+            if (rounds is None) or (counts[i] < rounds):
+                interval = intervals[i]
+                if needed is not None:
+                    interval = max(MIN_INTERVAL, min(interval, needed))
+                due += interval
+                late = time.time() - due
+                if late > 0:
+                    # skip missed polls instead of catching up
+                    due += (late // interval + 1) * interval
+                heapq.heappush(heap, self.heap_entry(due, i))
+
+        while heap or running:
+            now = time.time()
+            if (report is not None) and now >= next_report:
+                report(self.slip_report())
+                self.reset_slip()
+                next_report = now + SLIP_REPORT
+            if not heap or self.heap_job(heap[0])[0] > now:
+                # a running poll may add an earlier job, look again after a second
+                wait = 1.0
+                if heap:
+                    wait = min(wait, self.heap_job(heap[0])[0] - now)
+                if running:
+                    await asyncio.wait(running, timeout=wait)
+                else:
+                    await asyncio.sleep(wait)
+                continue
+            await slots.acquire()
+            due, i = self.heap_job(heapq.heappop(heap))
+            task = asyncio.ensure_future(start(i, due))
+            running.add(task)
+            task.add_done_callback(running.discard)
+
+async def poll_shard(shard, db, scheduler, emit, flush, fmt='tabs', rounds=None, report=None, properties=None,
+                     auths=None):
+    """ poll the targets of one process
+
+    :param shard: Target_table
+    :param db: Profile_db
+    :param scheduler: Poll_scheduler
+    :param emit: function called with each output line
+    :param flush: function called after each poll and when idle, sends the lines emitted
+    :param fmt: key of FORMATTERS
+    :param rounds: number of polls per target, None: forever
+    :param report: function called with the slip report (or None)
+    :param properties: Property_cache (or None), expired properties are refreshed besides the polls
+    :param auths: dict credentials file -> Digest_auth for the targets with --credentials
+    """
+    import asyncio
+
+    auths = auths or {}
+
+    # targets sharing host, port and type are polled only once: sorted by
+    # key, job j polls the rows starts[j] to starts[j + 1] - 1
+    shard.sort()
+    routers = dict([(short_id, db.find(short_id)) for short_id in shard.profiles])
+    starts = array.array('I', [i for i in range(len(shard)) if i == 0 or shard.key(i) != shard.key(i - 1)])
+    starts.append(len(shard))
+    hosts = [shard.host[starts[j]] for j in range(len(starts) - 1)]
+    intervals = array.array('I', [min(shard.interval[starts[j]:starts[j + 1]]) for j in range(len(starts) - 1)])
+
+    refreshing = {}     # (host, port) -> task
+    shipping = {}       # (spool, collector) -> future of Sample_spool.ship in a thread
+
+    def ship(spool, address):
+        # shipping blocks while connecting and sending, keep it out of the polls
+        if (spool, address) in shipping:
+            return
+
+        def done(future):
+            del shipping[(spool, address)]
+            if future.exception() is not None:
+                print("ng-upnp2mrtg3 [%s]: shipping %s to %s failed: %s"
+                      % (os.getpid(), spool, address, future.exception()), file=sys.stderr)
+
+        shipping[(spool, address)] = asyncio.get_event_loop().run_in_executor(
+            None, Sample_spool(spool).ship, address)
+        shipping[(spool, address)].add_done_callback(done)
+
+    async def poll_key(j):
+        short_id, host, port = shard.key(starts[j])
+        auth = auths.get(shard.sparse['credentials'].get(starts[j]))
+        props = None
+        if properties is not None:
+            props = properties.get(host, port)
+            if properties.expired(host, port) and (host, port) not in refreshing:
+                refreshing[(host, port)] = asyncio.ensure_future(
+                    properties.refresh_async(routers[short_id], host, port, auth=auth))
+                refreshing[(host, port)].add_done_callback(lambda task: refreshing.pop((host, port)))
+        sample = await poll(routers[short_id], host, port, auth=auth)
+        needed = None
+        for i in range(starts[j], starts[j + 1]):
+            t = shard[i]
+            line, interval = format_sample(t, routers[t.short_id], sample, fmt, props)
+            emit(line)
+            if (t.spool is not None) and (t.ship is not None):
+                ship(t.spool, t.ship)
+            if (needed is None) or interval < needed:
+                needed = interval
+        flush()
+        return needed
+
+    await scheduler.run(hosts, intervals, poll_key, rounds, report)
+    # keep the properties for the next run, finish the shipments
+    if refreshing or shipping:
+        await asyncio.wait(list(refreshing.values()) + list(shipping.values()))
+
+def shard_worker(shard, results, concurrency, profiles, rounds, fmt, rate=None, subnet_rate=None,
+                 properties=None):
+    """ main function of a polling process
+
+    :param shard: Target_table
+    :param results: multiprocessing.Queue, gets lists of output lines and None when done
+    :param concurrency: maximum number of routers polled at the same time
+    :param profiles: router definition files
+    :param rounds: number of polls, None: forever
+    :param fmt: key of FORMATTERS
+    :param rate: maximum number of polls per second of this process (or None)
+    :param subnet_rate: maximum number of polls per second and subnet of this process (or None)
+    :param properties: Property_cache (or None)
+    .note: the poll interval is taken from the targets and shortened if
+           counters may wrap more than once between two polls.  When running
+           forever the polls are spread over the interval (Poll_scheduler).
+    """
+    import asyncio
+
+    batch = []
+    parent = os.getppid()
+
+    def emit(line):
+        batch.append(line)
+
+    def flush():
+        if os.getppid() != parent:
+            # the main process is gone
+            os._exit(0)
+        if (len(batch) >= SHARD_BATCH) or (rounds is None and batch):
+            results.put(batch[:])
+            del batch[:]
+
+    def report(text):
+        print("ng-upnp2mrtg3 [%s]: %s" % (os.getpid(), text), file=sys.stderr)
+
+    # one authentication per credentials file, the challenges are shared by its targets
+    auths = {}
+    for filename in set(shard.sparse['credentials'].values()):
+        try:
+            auths[filename] = Digest_auth(*read_credentials(filename))
+        except (IOError, ValueError) as msg:
+            report(msg)
+
+    try:
+        db = Profile_db(profiles)
+        scheduler = Poll_scheduler(concurrency, rate, subnet_rate, spread=rounds is None)
+        asyncio.run(poll_shard(shard, db, scheduler, emit, flush, fmt, rounds, report if rounds is None else None,
+                               properties, auths))
+        if batch:
+            results.put(batch)
+        if global_debug and rounds is not None:
+            report(scheduler.slip_report())
+    finally:
+        # the main process waits for this even if the process fails
+        results.put(None)
+
+def poll_sharded(targets, workers, concurrency, output, profiles=None, rounds=1, fmt='tabs',
+                 rate=None, subnet_rate=None, properties=None):
+    """ poll targets with several processes
+
+    :param targets: list of Target or Target_table
+    :param workers: number of processes
+    :param concurrency: maximum number of routers polled at the same time by each process
+    :param output: function called with each batch (list of lines)
+    :param profiles: router definition files (default: PROFILE_FILES)
+    :param rounds: number of polls, None: forever
+    :param fmt: key of FORMATTERS
+    :param rate: maximum number of polls per second of all processes (or None)
+    :param subnet_rate: maximum number of polls per second and subnet (or None)
+    :param properties: Property_cache (or None)
+    .note: the rate limits are divided among the processes
+    """
+    import multiprocessing
+    import queue
+
+    ring = Hash_ring(range(workers))
+    shards = [Target_table() for i in range(workers)]
+    for t in targets:
+        shards[ring.node(t.host)].append(t)
+    shards = [shard for shard in shards if len(shard)]
+
+    if rate:
+        rate /= len(shards)
+    if subnet_rate:
+        subnet_rate /= len(shards)
+
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=shard_worker,
+                args=(shard, results, concurrency, profiles, rounds, fmt, rate, subnet_rate, properties))
+             for shard in shards]
+    for p in procs:
+        p.daemon = True
+        p.start()
+
+    running = len(procs)
+    while running > 0:
+        try:
+            batch = results.get(timeout=1)
+        except queue.Empty:
+            # a process killed before its end marker
+            if not [p for p in procs if p.is_alive()]:
+                break
+            continue
+        if batch is None:
+            running -= 1
+        else:
+            output(batch)
+
+    for p in procs:
+        p.join()
+
+def write_batch(lines):
+    """ write a batch of output lines to stdout at once
+    """
+    sys.stdout.write(''.join(lines))
+    sys.stdout.flush()
+
+#############################################################
+# combined targets
+#
+# Several routers (e.g. the WAN routers of one site) reported as a single
+# target.  The members are polled at the same time, each counter is
+# corrected by the nowrap file of its member, then they are combined.
+# Only linear combinations keep the result a counter: max or min of the
+# counters would jump whenever another member holds the extreme value.
+
+COMBINERS = {
+    'sum': sum,
+    'mean': lambda values: sum(values) // len(values),
+}
+
+def combine_members(members, db, combine='sum', auth=None):
+    """ poll the members of a combined target
+
+    :param members: list of Target
+    :param db: Profile_db
+    :param combine: key of COMBINERS
+    :param auth: Digest_auth for devices requiring authentication (or None)
+    :return: (inbytes, outbytes, uptime, long_id, comment), the counters are None
+             if a member could not be read, uptime is the shortest one (seconds)
+    """
+    import asyncio
+
+    routers = [db.find(t.short_id) for t in members]
+
+    async def poll_all():
+        return await asyncio.gather(*[poll(r, t.host, t.port, auth=auth)
+                                      for t, r in zip(members, routers)])
+
+    ins = []
+    outs = []
+    uptimes = []
+    comments = []
+    for t, r, sample in zip(members, routers, asyncio.run(poll_all())):
+        inbytes, outbytes, comment, interval = process_sample(t, sample.inbytes, sample.outbytes,
+                                                              sample.uptime, sample.time,
+                                                              series=series_name(t.host, t.port))
+        ins.append(inbytes)
+        outs.append(outbytes)
+        uptimes.append(uptime_seconds(sample.uptime))
+        if sample.error is not None:
+            comment += ' (%s: %s)' % (t.host, sample.error)
+        if comment and comment not in comments:
+            comments.append(comment)
+
+    # a missing member would look like a drop of the traffic
+    func = COMBINERS[combine]
+    inbytes = None if None in ins else func(ins)
+    outbytes = None if None in outs else func(outs)
+    known = [u for u in uptimes if u is not None]
+    uptime = min(known) if known else None
+
+    names = ['%s (%s)' % (r.long_id, t.host) for t, r in zip(members, routers)]
+    if combine == 'sum':
+        long_id = ' + '.join(names)
+    else:
+        long_id = '%s(%s)' % (combine, ', '.join(names))
+    return inbytes, outbytes, uptime, long_id, ''.join(comments)
+
+#############################################################
+# prefetch for MRTG
+#
+# MRTG runs the targets of mrtg.cfg one after the other.  Run right before
+# MRTG, --prefetch polls all targets calling this script at the same time
+# and stores the answers in their --cache directories, so the calls by
+# MRTG only read the results.
+
+def read_mrtg_targets(filename, seen=None):
+    """ find the invocations of this script in a MRTG configuration
+
+    :param filename: mrtg.cfg, "Include:" files are read as well
+    :param seen: files already read (to stop include loops)
+    :return: list of (target name, list of arguments)
+    """
+    if seen is None:
+        seen = set()
+    filename = os.path.abspath(filename)
+    if filename in seen:
+        return []
+    seen.add(filename)
+
+    # join continuation lines (starting with white space)
+    entries = []
+    for line in open(filename, 'r'):
+        line = line.rstrip('\r\n')
+        if line.startswith('#') or not line.strip():
+            continue
+        if line[0] in ' \t' and entries:
+            entries[-1] += ' ' + line.strip()
+        else:
+            entries.append(line)
+
+    targets = []
+    for entry in entries:
+        match = re.match(r'(?i)^include\s*:\s*(.+)$', entry)
+        if match is not None:
+            include = os.path.join(os.path.dirname(filename), match.group(1).strip())
+            targets += read_mrtg_targets(include, seen)
+            continue
+        match = re.match(r'^Target\[([^\]]+)\]\s*:\s*(.*)$', entry)
+        if match is None:
+            continue
+        for command in re.findall('`([^`]*)`', match.group(2)):
+            try:
+                words = shlex.split(command)
+            except ValueError:
+                continue
+            for i, word in enumerate(words):
+                if os.path.basename(word).startswith('ng-upnp2mrtg3'):
+                    targets.append((match.group(1), words[i + 1:]))
+                    break
+    return targets
+
+def prefetch_requests(opts, router, subscribed=False):
+    """ the requests an invocation will send
+
+    :param opts: parsed options of the invocation
+    :param router: Router selected by opts.type
+    :param subscribed: True if the uptime is known from events (Gena_subscriber)
+    :return: list of SoapAction
+    """
+    actions = [router.incoming, router.outgoing]
+    if not (subscribed or opts.uptime_every is not None):
+        # with --uptime-every the uptime is seldom asked
+        actions.append(router.uptime)
+    if (opts.history is not None) and (router.history is not None):
+        actions.append(router.history)
+    if (opts.spikes is not None) and (router.capacity is not None) and \
+            not (opts.maxbytes1 and opts.maxbytes2):
+        actions.append(router.capacity)
+    return actions
+
+async def prefetch(requests, concurrency=100, timeout=DEFAULT_TIMEOUT):
+    """ send requests and store the answers in the caches
+
+    :param requests: dict (cache directory, host, port, SoapAction) -> (ttl, Digest_auth or None)
+    :param concurrency: maximum number of requests at the same time
+    :param timeout: seconds to wait for each request
+    :return: number of failed requests
+    .note: the requests to one router are sent one after the other
+    """
+    import asyncio
+
+    by_router = collections.OrderedDict()
+    for (directory, host, port, action), (ttl, auth) in requests.items():
+        by_router.setdefault((directory, host, port), []).append((action, ttl, auth))
+
+    slots = asyncio.Semaphore(concurrency)
+    failed = [0]
+
+    async def fetch(directory, host, port, actions):
+        async with slots:
+            for action, ttl, auth in actions:
+                try:
+                    value = await query_async(host, port, action, timeout, auth)
+                except (UpnpError, OSError, asyncio.TimeoutError) as msg:
+                    if global_debug:
+                        print('%s:%s %s: %s' % (host, port, action.action, msg))
+                    # cached as well, as by Sample_cache.get
+                    value = None
+                    failed[0] += 1
+                cache = Sample_cache(directory, ttl)
+                cache.store(cache.filename((host, port, action.action) + tuple(action.args or ())), value)
+
+    await asyncio.gather(*[fetch(d, h, p, actions) for (d, h, p), actions in by_router.items()])
+    return failed[0]
+
+def prefetch_mrtg(filename, parser, db, concurrency=100):
+    """ poll all targets of a MRTG configuration using --cache
+
+    :param filename: mrtg.cfg
+    :param parser: ArgumentParser for the options
+    :param db: Profile_db
+    :param concurrency: maximum number of requests at the same time
+    :return: (number of targets, number of requests, number of failed requests)
+    """
+    import asyncio
+
+    requests = collections.OrderedDict()
+    targets = 0
+    for name, argv in read_mrtg_targets(filename):
+        try:
+            opts = parser.parse_args(argv)
+        except SystemExit:
+            print("*** Error in Target[%s] of %s" % (name, filename))
+            continue
+        router = db.find(opts.type)
+        if (router is None) or (opts.cache is None) or opts.targets or opts.member:
+            # nothing to prepare
+            continue
+        auth = None
+        if opts.credentials is not None:
+            try:
+                auth = Digest_auth(*read_credentials(opts.credentials),
+                                   cache=Sample_cache(opts.cache, opts.cache_ttl))
+            except (IOError, ValueError) as msg:
+                print("*** Target[%s]: %s" % (name, msg))
+        targets += 1
+        host = opts.host or router.host
+        port = opts.port or router.port
+        subscribed = (router.events is not None) and \
+            gena_uptime(Sample_cache(opts.cache, opts.cache_ttl), host, port) is not None
+        for action in prefetch_requests(opts, router, subscribed):
+            requests.setdefault((opts.cache, host, port, action), (opts.cache_ttl, auth))
+
+    failed = asyncio.run(prefetch(requests, concurrency))
+    return targets, len(requests), failed
+
+#############################################################
+# event subscription (GENA)
+#
+# WANIPConnection sends NOTIFY messages when ConnectionStatus or
+# ExternalIPAddress change.  The subscriber keeps the time of the last
+# (re)connect in the cache directory, polls then calculate the uptime
+# from it instead of sending GetStatusInfo.
+
+# requested duration of a subscription in seconds
+GENA_TIMEOUT = 1800
+
+def http_request(host, port, request):
+    """ send a HTTP request without body and read the answer
+
+    :param host: host name
+    :param port: port
+    :param request: request line and headers
+    :return: (status code, dict of headers with lower case names)
+    """
+    s = default_resolver.connect(host, port)
+    try:
+        s.settimeout(DEFAULT_TIMEOUT)
+        s.sendall(request.encode('utf-8'))
+        resp = b''
+        while b'\r\n\r\n' not in resp:
+            data = s.recv(1024)
+            if len(data) == 0:
+                break
+            resp += data
+    finally:
+        s.close()
+
+    head = resp.split(b'\r\n\r\n')[0].decode('utf-8', 'replace')
+    return get_response_code(head), scan_headers(head)
+
+class Gena_subscriber:
+    """ Subscribe to the events of WANIPConnection and keep the status in a Sample_cache
+
+    The status is stored as dict with the keys
+        status          ConnectionStatus, e.g. "Connected"
+        external_ip     ExternalIPAddress
+        since           time of the last connect (unix time)
+        expires         end of the subscription (unix time)
+    """
+
+    def __init__(self, router, host, port, cache, listen_port, timeout=GENA_TIMEOUT):
+        """ initialize
+
+        :param router: Router with events path
+        :param host: host name of UPNP server
+        :param port: port of UPNP server
+        :param cache: Sample_cache to store the status
+        :param listen_port: port for the NOTIFY messages
+        :param timeout: requested duration of a subscription in seconds
+        """
+        self.router = router
+        self.host = host
+        self.port = port
+        self.cache = cache
+        self.listen_port = listen_port
+        self.timeout = timeout
+        self.sid = None
+        self.lock = threading.Lock()
+        self.filename = cache.filename((host, port, 'events'))
+        self.state = {'status': None, 'external_ip': None, 'since': None, 'expires': 0}
+
+    def local_address(self):
+        """ our address as seen from the router
+
+        :return: (family, address)
+        """
+        family, sockaddr = default_resolver.resolve(self.host, self.port)[0]
+        s = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            s.connect(sockaddr)
+            return family, s.getsockname()[0]
+        finally:
+            s.close()
+
+    def callback_url(self):
+        """ URL of our NOTIFY listener as seen from the router
+        """
+        family, local = self.local_address()
+        if family == socket.AF_INET6:
+            # without the zone of a link-local address
+            local = '[%s]' % local.split('%')[0]
+        return 'http://%s:%s/events' % (local, self.listen_port)
+
+    def store(self):
+        self.cache.store(self.filename, self.state)
+
+    def query_status(self):
+        """ get the current status and uptime with GetStatusInfo
+        """
+        action = self.router.uptime
+        res = Upnpclient(self.host, self.port).query(action.path, action.schema, action.action,
+                                                    ('NewConnectionStatus', 'NewUptime'), action.args,
+                                                    (None, action.type))
+        if res is not None:
+            status, uptime = res
+            uptime = uptime_seconds(uptime)
+            with self.lock:
+                self.state['status'] = status
+                if uptime is not None:
+                    self.state['since'] = time.time() - uptime
+
+    def subscribe(self):
+        """ subscribe or renew the subscription
+
+        :return: True if successful
+        """
+        if self.sid is None:
+            header = 'CALLBACK: <%s>\r\nNT: upnp:event\r\n' % self.callback_url()
+        else:
+            header = 'SID: %s\r\n' % self.sid
+        request = 'SUBSCRIBE %s HTTP/1.1\r\nHOST: %s\r\n%sTIMEOUT: Second-%s\r\n\r\n' % (
+            self.router.events, host_header(self.host, self.port), header, self.timeout)
+        if global_debug:
+            print(request)
+
+        try:
+            code, headers = http_request(self.host, self.port, request)
+        except socket.error as msg:
+            print('Socket error:', msg)
+            code = None
+        if code != 200:
+            if self.sid is not None:
+                # renewal failed, try a new subscription
+                self.sid = None
+                return self.subscribe()
+            return False
+
+        self.sid = headers.get('sid', self.sid)
+        timeout = my_int(headers.get('timeout', '').lower().replace('second-', ''), self.timeout)
+        with self.lock:
+            self.state['expires'] = time.time() + timeout
+            self.store()
+        return True
+
+    def unsubscribe(self):
+        if self.sid is None:
+            return
+        request = 'UNSUBSCRIBE %s HTTP/1.1\r\nHOST: %s\r\nSID: %s\r\n\r\n' % (
+            self.router.events, host_header(self.host, self.port), self.sid)
+        try:
+            http_request(self.host, self.port, request)
+        except socket.error:
+            pass
+        self.sid = None
+        with self.lock:
+            self.state['expires'] = 0
+            self.store()
+
+    def notify(self, sid, body):
+        """ handle a NOTIFY message
+
+        :param sid: SID header of the message
+        :param body: property set (XML)
+        :return: True if the message belongs to our subscription
+        .note: the first message may arrive before the answer to SUBSCRIBE
+        """
+        import xml.etree.ElementTree as ET
+
+        if (self.sid is not None) and sid != self.sid:
+            return False
+        try:
+            root = ET.fromstring(body)
+        except ET.ParseError:
+            return True
+
+        values = {}
+        for prop in root:
+            for var in prop:
+                values[var.tag.split('}')[-1]] = var.text
+        if global_debug:
+            print('event:', values)
+
+        with self.lock:
+            status = values.get('ConnectionStatus')
+            if status is not None:
+                if status == 'Connected' and self.state['status'] != 'Connected':
+                    self.state['since'] = time.time()
+                self.state['status'] = status
+            if 'ExternalIPAddress' in values:
+                self.state['external_ip'] = values['ExternalIPAddress']
+            self.store()
+        return True
+
+    def run(self):
+        """ subscribe and handle events until interrupted
+        """
+        import http.server
+
+        subscriber = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_NOTIFY(self):
+                length = my_int(self.headers.get('Content-Length'), 0)
+                ok = subscriber.notify(self.headers.get('SID'), self.rfile.read(length))
+                self.send_response(200 if ok else 412)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                if global_debug:
+                    http.server.BaseHTTPRequestHandler.log_message(self, *args)
+
+        # listen in the family used to reach the router
+        class Server(http.server.ThreadingHTTPServer):
+            address_family = self.local_address()[0]
+
+        server = Server(('::' if Server.address_family == socket.AF_INET6 else '', self.listen_port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.query_status()
+        try:
+            while True:
+                if self.subscribe():
+                    # renew after half of the granted time
+                    time.sleep(max(10, (self.state['expires'] - time.time()) / 2))
+                else:
+                    time.sleep(60)
+                    self.query_status()
+        finally:
+            self.unsubscribe()
+            server.shutdown()
+
+def gena_uptime(cache, host, port):
+    """ get the uptime from the status kept by Gena_subscriber
+
+    :param cache: Sample_cache
+    :param host: host name of UPNP server
+    :param port: port of UPNP server
+    :return: uptime in seconds as string (as returned by GetStatusInfo) or
+             None if there is no valid subscription
+    """
+    entry = cache.load(cache.filename((host, port, 'events')))
+    if entry is None:
+        return None
+    state = entry[1]
+    now = time.time()
+    if (state.get('expires', 0) < now) or (state.get('since') is None):
+        return None
+    if state.get('status') != 'Connected':
+        return '0'
+    return str(int(now - state['since']))
+
+def list_models(db):
+    """ output nicely formatted list
+
+    :param db: Profile_db
+    :return:
+    """
+    models = db.models()
+
+    if len(models) == 0:
+        print("No models available")
+        return
+
+    print("Model id        Description")
+    print("--------        -----------")
+
+    for short_id, long_id in models:
+        print("%-15s %s" % (short_id, long_id))
+
+def build_parser():
+    """ create the parser for the command line (and the lines of --targets)
+
+    :return: ArgumentParser
+    """
+    parser = argparse.ArgumentParser(description='query UPNP router', add_help=False)
+    parser.add_argument('--host', '-h',
+                        help='host ip')
+    parser.add_argument('--port', '-p',
+                        type=int,
+                        help='port number')
+    parser.add_argument('--type', '-t',
+                        help='type of router')
+    parser.add_argument('--list', '-l',
+                        action='store_true',
+                        help='list available routers')
+    parser.add_argument('--profiles',
+                        action='append',
+                        default=[],
+                        help='read additional router definitions from this file')
+    parser.add_argument('--rawlog',
+                        help='save raw values in this file')
+    parser.add_argument('--mrtglog',
+                        help='maintain this MRTG log file (as written by rateup) with the corrected counters')
+    parser.add_argument('--nowrap',
+                        help='activate anti-wrap, store status in this file')
+    parser.add_argument('--history',
+                        help='append the traffic history of the device to this file (Fritzbox only)')
+    parser.add_argument('--cache',
+                        help='share results with other invocations, store them in this directory')
+    parser.add_argument('--cache-ttl',
+                        type=int,
+                        default=60,
+                        help='maximum age of shared results in seconds (default: 60)')
+    parser.add_argument('--properties',
+                        metavar='DIR',
+                        help='keep model, firmware, link capacity and external IP of the devices in this directory')
+    parser.add_argument('--properties-ttl',
+                        type=int,
+                        default=PROPERTIES_TTL,
+                        help='refresh the properties in the background after this many seconds (default: %s)'
+                             % PROPERTIES_TTL)
+    parser.add_argument('--describe',
+                        action='store_true',
+                        help='show the properties of the device and the MaxBytes for mrtg.cfg, then exit')
+    parser.add_argument('--credentials',
+                        help='file with "user:password" for devices requiring authentication (TR-064)')
+    parser.add_argument('--maxbytes1',
+                        type=int,
+                        help='capacity of the link in bytes/s (incoming), as MaxBytes1 in mrtg.cfg')
+    parser.add_argument('--maxbytes2',
+                        type=int,
+                        help='capacity of the link in bytes/s (outgoing), as MaxBytes2 in mrtg.cfg')
+    parser.add_argument('--spikes',
+                        choices=['reject', 'clamp'],
+                        help='reject or clamp increases beyond the link capacity (needs --nowrap)')
+    parser.add_argument('--spool',
+                        metavar='DIR',
+                        help='keep the samples in this directory until they are shipped (see --ship)')
+    parser.add_argument('--ship',
+                        metavar='HOST:PORT',
+                        help='send the samples in --spool to this collector (helper/collector.py)')
+    parser.add_argument('--uptime-every',
+                        type=int,
+                        metavar='N',
+                        help='ask the device for the uptime only every N polls, extrapolate in between (needs --nowrap)')
+    parser.add_argument('--interval',
+                        type=int,
+                        default=300,
+                        help='poll interval in seconds (default: 300, as used by MRTG)')
+    parser.add_argument('--targets',
+                        help='poll all targets in this file, one line of options per target')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=os.cpu_count(),
+                        help='number of processes polling --targets (default: number of cores)')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=100,
+                        help='number of routers polled at the same time by each process (default: 100)')
+    parser.add_argument('--rate',
+                        type=float,
+                        help='maximum number of routers polled per second with --targets or --stream')
+    parser.add_argument('--subnet-rate',
+                        type=float,
+                        help='maximum number of routers polled per second in each /24 (IPv6: /64) subnet')
+    parser.add_argument('--member',
+                        action='append',
+                        default=[],
+                        metavar='OPTIONS',
+                        help='poll this router (options in quotes) as part of a combined target, repeat for each')
+    parser.add_argument('--combine',
+                        choices=sorted(COMBINERS),
+                        default='sum',
+                        help='how the counters of the --member routers are combined (default: sum)')
+    parser.add_argument('--prefetch',
+                        metavar='MRTG_CFG',
+                        help='poll all targets in this MRTG configuration at once and fill their --cache, then exit')
+    parser.add_argument('--stream',
+                        choices=['collectd', 'influx'],
+                        help='keep running and write values for collectd (PUTVAL) or telegraf (influx line protocol)')
+    parser.add_argument('--subscribe',
+                        type=int,
+                        metavar='PORT',
+                        help='keep running, subscribe to status events and receive them on PORT (needs --cache)')
+    parser.add_argument('--record',
+                        metavar='FILE',
+                        help='append all requests and answers with their timing to this capture file')
+    parser.add_argument('--replay',
+                        metavar='FILE',
+                        help='answer the requests from this capture file instead of the device')
+    parser.add_argument('--replay-speed',
+                        type=float,
+                        default=1.0,
+                        help='speed-up of the recorded timing for --replay, 0: no delays (default: 1)')
+    parser.add_argument('--debug',
+                        action='store_true',
+                        help='display communication')
+    parser.add_argument('--help',                   # as we have disabled it with "add_help=False"
+                        action='help',              # we need to add it manually for "--help"
+                        help='show this help message and exit')
+
+    return parser
+
+def main():
+    global global_debug
+
+    parser = build_parser()
+    args = parser.parse_args()
+
+    try:
+        db = Profile_db(PROFILE_FILES + args.profiles)
+    except (ValueError, configparser.Error) as msg:
+        print("*** Error in router definitions: %s" % msg)
+        parser.exit(1)
+
+    if args.list is True:
+        parser.print_help()
+        print()
+        list_models(db)
+        parser.exit(0)                   # = sys.exit(0)
+
+    global_debug = args.debug
+
+    # collectd tells the exec plugin its interval
+    if (args.stream == 'collectd') and os.environ.get('COLLECTD_INTERVAL'):
+        parser.set_defaults(interval=int(float(os.environ['COLLECTD_INTERVAL'])))
+        args = parser.parse_args()
+
+    # with --targets each target needs its own --nowrap (see parse_target)
+    if (args.spikes is not None) and (args.nowrap is None) and (args.targets is None):
+        parser.error("--spikes needs --nowrap")
+    if (args.uptime_every is not None) and (args.nowrap is None):
+        parser.error("--uptime-every needs --nowrap")
+
+    if args.prefetch is not None:
+        start = time.time()
+        try:
+            targets, requests, failed = prefetch_mrtg(args.prefetch, parser, db, args.concurrency)
+        except IOError as msg:
+            print("*** Error: %s" % msg)
+            parser.exit(1)
+        print("%s targets, %s requests (%s failed) in %.1fs" % (targets, requests, failed, time.time() - start))
+        parser.exit(0)
+
+    # the spool and credentials of the poller are also used by the targets and members
+    parser.set_defaults(spool=args.spool, ship=args.ship, credentials=args.credentials)
+
+    if args.member:
+        members = [parse_target(m, parser, db, "--member %s" % m) for m in args.member]
+        auth = None
+        if args.credentials is not None:
+            try:
+                auth = Digest_auth(*read_credentials(args.credentials))
+            except (IOError, ValueError) as msg:
+                print("*** Error: %s\n" % msg)
+                parser.exit(1)
+
+        inbytes, outbytes, uptime, long_id, comment = combine_members(members, db, args.combine, auth)
+        # options given outside --member apply to the combined counters
+        series = '+'.join([series_name(t.host, t.port) for t in members])
+        inbytes, outbytes, comment2, interval = process_sample(args, inbytes, outbytes, uptime, time.time(),
+                                                               series=series)
+
+        print(none2unknown(inbytes))
+        print(none2unknown(outbytes))
+        print(none2unknown(None) if uptime is None else dhms(uptime))
+        print(long_id + comment + comment2)
+        parser.exit(0)
+
+    if args.targets is not None:
+        # the poll options given on the command line apply to all targets
+        parser.set_defaults(interval=args.interval, maxbytes1=args.maxbytes1, maxbytes2=args.maxbytes2,
+                            spikes=args.spikes)
+        targets = read_targets(args.targets, parser, db)
+    else:
+        if args.type is None:
+            print("*** Error: router type not given\n")
+            list_models(db)
+            parser.exit(1)
+
+        selected_model = db.find(args.type)
+        if selected_model is None:
+            print("*** Error: unknown router type %s\n" % args.type)
+            list_models(db)
+            parser.exit(1)
+
+        targets = [opts2target(args, selected_model)]
+
+    properties = None
+    if args.properties is not None:
+        properties = Property_cache(args.properties, args.properties_ttl)
+
+    if (args.targets is not None) or (args.stream is not None):
+        for filename in set([t.credentials for t in targets if t.credentials is not None]):
+            try:
+                read_credentials(filename)
+            except (IOError, ValueError) as msg:
+                print("*** Error: %s\n" % msg)
+                parser.exit(1)
+        rounds = 1
+        if args.stream is not None:
+            rounds = None
+        poll_sharded(targets, max(1, min(args.workers, len(targets))), args.concurrency, write_batch,
+                     profiles=PROFILE_FILES + args.profiles, rounds=rounds, fmt=args.stream or 'tabs',
+                     rate=args.rate, subnet_rate=args.subnet_rate, properties=properties)
+        parser.exit(0)
+
+    if (args.history is not None) and (selected_model.history is None):
+        print("*** Error: router type %s has no traffic history\n" % args.type)
+        parser.exit(1)
+
+    host = args.host
+    if not host:
+        host = selected_model.host
+
+    port = args.port
+    if not port:
+        port = selected_model.port
+
+    cache = None
+    if args.cache is not None:
+        cache = Sample_cache(args.cache, args.cache_ttl)
+
+    if args.subscribe is not None:
+        if (cache is None) or (selected_model.events is None):
+            print("*** Error: --subscribe needs --cache and a router type with events\n")
+            parser.exit(1)
+        # unsubscribe when stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            Gena_subscriber(selected_model, host, port, cache, args.subscribe).run()
+        except KeyboardInterrupt:
+            pass
+        parser.exit(0)
+
+    auth = None
+    if args.credentials is not None:
+        try:
+            auth = Digest_auth(*read_credentials(args.credentials), cache=cache)
+        except (IOError, ValueError) as msg:
+            print("*** Error: %s\n" % msg)
+            parser.exit(1)
+
+    if args.describe:
+        import asyncio
+
+        if properties is None:
+            props = asyncio.run(fetch_properties(selected_model, host, port, auth=auth))
+        else:
+            props = properties.refresh(selected_model, host, port, auth) or properties.get(host, port)
+        for name in ('model', 'firmware', 'external_ip'):
+            print('%-12s %s' % (name + ':', none2unknown(props.get(name))))
+        bits = props.get('capacity') or (None, None)
+        print('%-12s %s bit/s down, %s bit/s up' % ('capacity:', none2unknown(bits[0]), none2unknown(bits[1])))
+        maxbytes = property_capacity(props)
+        if None not in maxbytes:
+            print()
+            print('MaxBytes1[...]: %s' % maxbytes[0])
+            print('MaxBytes2[...]: %s' % maxbytes[1])
+        parser.exit(0)
+
+    transport = Socket_transport()
+    if args.replay is not None:
+        try:
+            transport = Replay_transport(args.replay, args.replay_speed)
+        except (IOError, ValueError, KeyError) as msg:
+            print("*** Error in capture file %s: %s\n" % (args.replay, msg))
+            parser.exit(1)
+    if args.record is not None:
+        transport = Recording_transport(transport, args.record)
+
+    # query the box
+    uc = Upnpclient(host, port, cache, auth, transport)
+    inbytes  = uc.send_command(selected_model.incoming.path, selected_model.incoming.schema,
+            selected_model.incoming.action, selected_model.incoming.tag, types=selected_model.incoming.type)
+    # time of the counters, a cached answer is older
+    now = uc.query_time
+    # the first error is shown in the description
+    error = uc.last_error
+    outbytes = uc.send_command(selected_model.outgoing.path, selected_model.outgoing.schema,
+            selected_model.outgoing.action, selected_model.outgoing.tag, types=selected_model.outgoing.type)
+    error = error or uc.last_error
+    uptime = None
+    uptime_queried = None
+    if args.uptime_every is not None:
+        uptime_queried = True
+    if (cache is not None) and (selected_model.events is not None):
+        uptime = gena_uptime(cache, host, port)
+    if (uptime is None) and (args.uptime_every is not None):
+        uptime = Nowrap_handler(args.nowrap).extrapolated_uptime(inbytes, outbytes,
+                args.uptime_every, time.monotonic())
+        if uptime is not None:
+            uptime_queried = False
+    if uptime is None:
+        uptime = uc.send_command(selected_model.uptime.path, selected_model.uptime.schema,
+                selected_model.uptime.action, selected_model.uptime.tag, types=selected_model.uptime.type)
+        error = error or uc.last_error
+
+    uptime_str = selected_model.uptime_conv(uptime)
+
+    # merge the history of the device (if requested)
+    if args.history is not None:
+        ha = selected_model.history
+        rates = uc.send_command(ha.path, ha.schema, ha.action, ha.tag, ha.args, ha.type)
+        error = error or uc.last_error
+        if rates is not None:
+            History_handler(args.history).merge(uc.query_time, *rates)
+
+    # link capacity reported by the device for the spike filter
+    capacity = (None, None)
+    ca = selected_model.capacity
+    props = {}
+    if properties is not None:
+        props = properties.get(host, port)
+        capacity = property_capacity(props)
+    elif (args.spikes is not None) and (ca is not None) and not (args.maxbytes1 and args.maxbytes2):
+        bits = uc.send_command(ca.path, ca.schema, ca.action, ca.tag, ca.args, ca.type)
+        if bits is not None:
+            capacity = tuple([b // 8 if b else None for b in bits])
+
+    inbytes, outbytes, comment, interval = process_sample(args, inbytes, outbytes, uptime, now, capacity,
+                                                          series_name(host, port), uptime_queried)
+
     # output for MRTG
     print(none2unknown(inbytes))
     print(none2unknown(outbytes))
     print(uptime_str)
-    print(selected_model.long_id + logindicator)
+    if error is not None:
+        comment += ' (error: %s)' % (error,)
+    print(selected_model.long_id + property_label(props) + comment)
+
+    # a replay is not sent to the device
+    if (properties is not None) and properties.expired(host, port) and (args.replay is None):
+        properties.refresh_in_background(selected_model, host, port, auth)
 
 if __name__ == "__main__":
     main()